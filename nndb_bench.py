@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D203,D204,D205,D209,D400,E501,D213
+
+"""nndb_bench.py
+
+Benchmark the record parsers in nndb_import against a single SR data file
+(NUT_DATA.txt by default, since it's the big one):
+
+   Name    Parser
+   ======= ==========================================
+   dicts   nndb_recs - a dict per line, numerics left as strings
+   text    nndb_tuples - records, text mode, numerics via num
+   mmap    mmap_tuples - records, bytes level, numerics from bytes
+   copies  mmap_tuples without shared fields - a new string per value
+
+Besides the time, the memory the parsed records hold (and the peak while
+parsing) is measured with tracemalloc over one more parse per parser.
+
+Run `./nndb_bench.py --help` for details.
+"""
+
+import gc
+import os
+import time
+import argparse
+import tracemalloc
+
+import nndb_import
+
+
+def parse_dicts(filename, record_cls):
+    return nndb_import.nndb_recs(filename, record_cls.doc_fields)
+
+
+def parse_copies(filename, record_cls):
+    unshared = nndb_import.record_type(record_cls.__name__, [
+        fld._replace(shared=False) for fld in record_cls.schema
+    ])
+    return nndb_import.mmap_tuples(filename, unshared)
+
+
+BENCHMARKS = [
+    ("dicts", parse_dicts),
+    ("text", nndb_import.nndb_tuples),
+    ("mmap", nndb_import.mmap_tuples),
+    ("copies", parse_copies),
+]
+
+
+def time_parser(parser, filename, record_cls, repeat):
+    """Return (row count, best wall time) over repeat full parses"""
+    best, rows = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = 0
+        for _ in parser(filename, record_cls):
+            rows += 1
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return rows, best
+
+
+def parser_memory(parser, filename, record_cls):
+    """Return (bytes held by a list of every record, peak bytes) for a
+    full parse, as traced by tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        recs = list(parser(filename, record_cls))
+        held, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del recs
+    return held, peak
+
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "targetdir",
+        help="The directory containing the ASCII data files"
+    )
+    parser.add_argument(
+        "--file",
+        help="The data file to parse",
+        choices=list(nndb_import.SR_FILES.keys()),
+        default="NUT_DATA.txt"
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Number of runs per parser (the best is reported)",
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        "--no-memory",
+        help="Skip measuring memory with tracemalloc",
+        action="store_true"
+    )
+    args = parser.parse_args()
+
+    filename = os.path.join(args.targetdir, args.file)
+    record_cls = nndb_import.SR_FILES[args.file]
+    print("Parsing %s (%d bytes), best of %d" % (filename, os.path.getsize(filename), args.repeat))
+
+    # The two record parsers must agree before their times mean anything
+    if list(nndb_import.nndb_tuples(filename, record_cls)) != list(nndb_import.mmap_tuples(filename, record_cls)):
+        raise ValueError("text and mmap parsers disagree on %s" % filename)
+
+    baseline = None
+    for name, bench in BENCHMARKS:
+        rows, elapsed = time_parser(bench, filename, record_cls, args.repeat)
+        if baseline is None:
+            baseline = elapsed
+        memory = ""
+        if not args.no_memory:
+            held, peak = parser_memory(bench, filename, record_cls)
+            memory = " %8.1fMB held %8.1fMB peak" % (held / 1e6, peak / 1e6)
+        print("  %-6s %9d rows %8.3fs %12.0f rows/s %6.2fx%s" % (
+            name, rows, elapsed, rows / elapsed, baseline / elapsed, memory
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# pylama:ignore=D203,D204,D205,D209,D400,E501,D213
+
+"""nndb_crashtest.py
+
+Crash push mode imports part way through and check that --resume finishes
+them with exactly the documents of an import that never crashed. Runs
+against mongomock (pip install mongomock), so no MongoDB is needed.
+
+Every run makes the bulk execute number N apply only the first half of its
+ops and then fail with AutoReconnect (a chunk that was half written when
+the connection went), checks the checkpoint, resumes, and compares every
+document with the reference import. That is repeated for --crashes points
+spread over the import, for each of these setups:
+
+   Name         Setup
+   ============ ========================================
+   serial       one phase at a time, one writer
+   partitioned  --writers 3 (PartitionedBulk)
+   concurrent   --phases 4
+   both         --writers 3 --phases 4
+
+Run `./nndb_crashtest.py --help` for details.
+"""
+
+import io
+import sys
+import json
+import argparse
+import threading
+import contextlib
+
+import pymongo.errors
+
+import nndb_import
+
+try:
+    import mongomock
+except ImportError:
+    sys.stderr.write("\n\nCould not import mongomock - it is required\n\n")
+    raise
+
+# mongomock only has the pymongo 3.x+ names for these
+if not hasattr(mongomock.collection.Collection, "count"):
+    mongomock.collection.Collection.count = lambda self, filter=None: self.count_documents(filter or {})
+if not hasattr(mongomock.database.Database, "collection_names"):
+    mongomock.database.Database.collection_names = lambda self, include_system_collections=True: self.list_collection_names()
+
+
+SETUPS = [
+    ("serial", dict(writers=1, phases=1)),
+    ("partitioned", dict(writers=3, phases=1)),
+    ("concurrent", dict(writers=1, phases=4)),
+    ("both", dict(writers=3, phases=4)),
+]
+
+
+def dump(mongo):
+    """Every document of mongo as sorted JSON, for comparing imports"""
+    docs = sorted(mongo.find(), key=lambda doc: doc["_id"])
+    return json.dumps(docs, sort_keys=True, default=nndb_import.json_binary)
+
+
+class Crash(object):
+    """Replaces ChunkedBulk.execute: the crash_at'th call only executes the
+    first half of its ops and then loses the connection"""
+
+    def __init__(self, crash_at):
+        self.crash_at = crash_at
+        self.calls = 0
+        self.lock = threading.Lock()  # Writers and phases may execute at once
+        self.execute = nndb_import.ChunkedBulk.execute
+
+    def __enter__(self):
+        crash = self
+
+        def execute(bulk, ops):
+            with crash.lock:
+                crash.calls += 1
+                call = crash.calls
+            if call == crash.crash_at:
+                if len(ops) > 1:
+                    crash.execute(bulk, ops[:len(ops) // 2])
+                raise pymongo.errors.AutoReconnect("crash at bulk execute %d" % crash.crash_at)
+            return crash.execute(bulk, ops)
+
+        nndb_import.ChunkedBulk.execute = execute
+        return self
+
+    def __exit__(self, *exc):
+        nndb_import.ChunkedBulk.execute = self.execute
+
+
+def import_push(mongo, targetdir, chunk_size, resume=False, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        nndb_import.process_directory(
+            mongo, targetdir, mode="push", chunk_size=chunk_size, resume=resume, **kwargs
+        )
+
+
+def crash_and_resume(targetdir, expected, crash_at, chunk_size, **kwargs):
+    """Crash an import at bulk execute crash_at and resume it. Returns
+    (crashed, checkpoint left after the crash, resumed matches expected,
+    checkpoints left after the resume)."""
+    mongo = mongomock.MongoClient().db.nndb
+    checkpoints = mongo.database[nndb_import.CHECKPOINT_COLLECTION]
+    crashed = False
+    with Crash(crash_at):
+        try:
+            import_push(mongo, targetdir, chunk_size, **kwargs)
+        except pymongo.errors.AutoReconnect:
+            crashed = True
+    saved = checkpoints.find_one() is not None
+    import_push(mongo, targetdir, chunk_size, resume=True, **kwargs)
+    return crashed, saved, dump(mongo) == expected, checkpoints.count()
+
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "targetdir",
+        help="The directory (or archive) containing the ASCII data files"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Ops per bulk execute - small chunks give more points to crash at",
+        type=int,
+        default=200
+    )
+    parser.add_argument(
+        "--crashes",
+        help="Number of crash points per setup",
+        type=int,
+        default=7
+    )
+    parser.add_argument(
+        "--setup",
+        help="Only run this setup",
+        choices=[name for name, _ in SETUPS],
+        default=None
+    )
+    args = parser.parse_args()
+    nndb_import.BULK_RETRY_DELAY = 0
+
+    print("Reference import of %s" % args.targetdir)
+    mongo = mongomock.MongoClient().db.nndb
+    with Crash(0) as counter:
+        import_push(mongo, args.targetdir, args.chunk_size)
+    expected = dump(mongo)
+    executes = counter.calls
+    points = sorted(set(1 + executes * i // args.crashes for i in range(args.crashes)))
+    print("%d foods, %d bulk executes, crashing at %s" % (mongo.count(), executes, points))
+
+    failures = 0
+    for name, kwargs in SETUPS:
+        if args.setup and name != args.setup:
+            continue
+        for crash_at in points:
+            crashed, saved, same, left = crash_and_resume(
+                args.targetdir, expected, crash_at, args.chunk_size, **kwargs
+            )
+            ok = crashed and saved and same and not left
+            failures += not ok
+            print("  %-12s crash at %5d: %s%s" % (
+                name, crash_at, "ok" if ok else "FAILED",
+                "" if ok else " (crashed %s, checkpoint %s, same documents %s, checkpoints left %d)" % (
+                    crashed, saved, same, left
+                )
+            ))
+
+    print("%d failures" % failures)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,9 +31,31 @@ as the four "principal" files are the first four listed:
 
 import sys
 import os
+import io
+import asyncio
+import gzip
+import json
+import math
+import time
+import mmap
+import queue
+import base64
+import struct
+import bisect
+import pickle
+import sqlite3
+import tarfile
+import zipfile
+import hashlib
+import tempfile
 import argparse
+import threading
+import contextlib
+import tracemalloc
+import operator
 import collections
 import functools
+import concurrent.futures
 
 
 class BulkFailure(Exception):
@@ -41,7 +63,13 @@ class BulkFailure(Exception):
     pass
 
 
+class SortOrderError(Exception):
+    """A data file was not sorted by NDB_No as a merge-join requires"""
+    pass
+
+
 try:
+    import bson
     import pymongo
 except:
     sys.stderr.write("\n\nCould not import PyMongo - it is required\n\n")
@@ -50,6 +78,11 @@ if (2, 6) > tuple([int(i) for i in getattr(pymongo, 'version', '0.0.0').split('.
     sys.stderr.write("\n\nNeed PyMongo version >= 2.6 - we use bulk loading\n\n")
     raise BulkFailure("PyMongo version too low")
 
+try:
+    import resource  # Peak RSS for ImportMetrics, not available on Windows
+except ImportError:
+    resource = None
+
 
 # Use the unit abbreviations we like - this means that the units to expect are:
 #   mcg  - micrograms
@@ -79,12 +112,6 @@ def nndb_recs(filename, field_names=None):
     if not field_names:
         raise ValueError("No fields specified for nndb recs")
 
-    # Filter for a single field in the file
-    def filt(f):
-        if len(f) > 1 and f[0] == '~' and f[-1] == '~':
-            f = f[1:-1]
-        return f
-
     # Note the encoding - the documentation says the files are in
     # "ASCII (ISO/IEC 8859-1)" which might make you think you could assume
     # an encoding of ASCII or UTF-8, but they actually do use 8859-1 (latin_1)
@@ -94,10 +121,154 @@ def nndb_recs(filename, field_names=None):
             line = line.strip()
             if len(line) < 1:
                 continue
-            yield dict([
-                (name, filt(fld))
-                for name, fld in zip(field_names, line.split('^'))
-            ])
+            yield dict(zip(field_names, split_fields(line)))
+
+
+def unquote(f):
+    """Filter for a single field in the file: text fields are wrapped in ~"""
+    if len(f) > 1 and f[0] == '~' and f[-1] == '~':
+        f = f[1:-1]
+    return f
+
+
+def split_fields(line):
+    """Split a single (stripped) line into its unquoted fields"""
+    return [unquote(fld) for fld in line.split('^')]
+
+
+def fit_fields(flds, width):
+    """Trim (or pad with empty strings) a list of fields to width"""
+    if len(flds) != width:
+        flds = (flds + [""] * width)[:width]
+    return flds
+
+
+# Schema field types: text is stored as-is, float is converted like num
+# (so an empty or unparseable value is "")
+TEXT = "text"
+FLOAT = "float"
+FIELD_TYPES = (TEXT, FLOAT)
+
+
+# A single field in an SR file. nullable is as given in the SR docs; note
+# that an empty value in any field (nullable or not) is stored as "". A
+# shared TEXT field has few distinct values (codes, NDB numbers in child
+# files), so the parsers hand out one string object per value instead of a
+# copy per row.
+Field = collections.namedtuple("Field", ["name", "type", "nullable", "shared"])
+Field.__new__.__defaults__ = (False,)
+
+
+def nndb_tuples(filename, record_cls):
+    """Like nndb_recs, but yields record_cls (see record_type) instances
+    instead of building a dictionary for every line. FLOAT fields are
+    converted with num."""
+    make, width = record_cls._make, len(record_cls.doc_fields)
+    float_index = record_cls.float_index
+    shared_index = record_cls.shared_index
+    with open(filename, "r", encoding="latin_1") as datafile:
+        for line in datafile:
+            line = line.strip()
+            if len(line) < 1:
+                continue
+            flds = fit_fields(split_fields(line), width)
+            for i in float_index:
+                flds[i] = num(flds[i])
+            for i in shared_index:
+                flds[i] = sys.intern(flds[i])
+            yield make(flds)
+
+
+def bytes_fields(line, record_cls, memo=None):
+    """The bytes level version of split_fields/fit_fields/num for a single
+    raw line: only text fields are unquoted and decoded (as latin_1) and
+    FLOAT fields go straight from bytes to float. Returns None for blank
+    lines. Note that only ASCII whitespace is stripped. memo (raw bytes =>
+    string) is where shared fields are remembered: pass the same dict for
+    every line of a parse."""
+    line = line.strip()
+    if not line:
+        return None
+
+    flds = line.split(b'^')
+    width = len(record_cls.doc_fields)
+    if len(flds) != width:
+        flds = (flds + [b""] * width)[:width]
+
+    for i in record_cls.plain_text_index:
+        f = flds[i]
+        if len(f) > 1 and f[0] == 126 and f[-1] == 126:  # 126 is ~
+            f = f[1:-1]
+        flds[i] = f.decode("latin_1")
+
+    # Shared fields are looked up by their raw bytes, so a value seen
+    # before isn't even decoded again
+    if memo is None:
+        memo = {}
+    for i in record_cls.shared_index:
+        f = flds[i]
+        text = memo.get(f)
+        if text is None:
+            text = f[1:-1] if len(f) > 1 and f[0] == 126 and f[-1] == 126 else f
+            text = memo[f] = sys.intern(text.decode("latin_1"))
+        flds[i] = text
+
+    for i in record_cls.float_index:
+        f = flds[i]
+        if len(f) > 1 and f[0] == 126 and f[-1] == 126:
+            f = f[1:-1]
+        if not f:
+            flds[i] = ""
+            continue
+        try:
+            flds[i] = float(f)
+        except ValueError:
+            flds[i] = ""
+
+    return flds
+
+
+def mmap_tuples(filename, record_cls):
+    """Fast path version of nndb_tuples: the file is mmap'ed and parsed at
+    the bytes level with bytes_fields"""
+    make, memo = record_cls._make, {}
+    with open(filename, "rb") as datafile:
+        if os.fstat(datafile.fileno()).st_size < 1:
+            return  # Can't mmap an empty file
+        with mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                flds = bytes_fields(line, record_cls, memo)
+                if flds is not None:
+                    yield make(flds)
+
+
+def record_type(name, schema):
+    """Build a namedtuple class for the records of one SR file from its
+    schema (a list of Field). Attribute names are the field names without a
+    leading underscore (so _id is rec.id) and as_dict() returns the document
+    form with the real names."""
+    for fld in schema:
+        if fld.type not in FIELD_TYPES:
+            raise ValueError("Unknown type %s for field %s" % (fld.type, fld.name))
+        if fld.shared and fld.type != TEXT:
+            raise ValueError("Only TEXT fields can be shared, not %s" % fld.name)
+
+    field_names = [fld.name for fld in schema]
+    base = collections.namedtuple(name, [f.lstrip('_') for f in field_names])
+
+    def as_dict(self):
+        return dict(zip(self.doc_fields, self))
+
+    return type(name, (base,), {
+        "__doc__": "Record from an SR file: %s" % ", ".join(field_names),
+        "__slots__": (),
+        "schema": tuple(schema),
+        "doc_fields": tuple(field_names),
+        "float_index": tuple(i for i, fld in enumerate(schema) if fld.type == FLOAT),
+        "plain_text_index": tuple(i for i, fld in enumerate(schema) if fld.type == TEXT and not fld.shared),
+        "shared_index": tuple(i for i, fld in enumerate(schema) if fld.shared),
+        "as_dict": as_dict,
+    })
 
 
 def recs_to_dict(keyfldname, recs):
@@ -113,61 +284,640 @@ def recs_to_lookup(filename):
     """Unlike recs_to_dict, we turn a 2-column data file (where the cols are
     assumed to be key and value) into a dictionary
     """
+    return pairs_to_lookup(lookup_recs(filename))
+
+
+def pairs_to_lookup(recs):
+    """Build the recs_to_lookup dictionary from key/val records"""
     d = {"": ""}
-    for flds in nndb_recs(filename, ["key", "val"]):
+    for flds in recs:
         d[flds["key"]] = flds["val"]
     return d
 
 
-food_des_recs = functools.partial(nndb_recs, field_names=[
-    "_id",  # aka NDB_No
-    "food_group_code",  # references the food group descriptions
-    "descrip",
-    "short_descrip",
-    "common_name",
-    "mfg_name",
-    "survey",  # if used in FNDDS (if so, nutrient data should be complete)
-    "refuse_descrip",  # description of inedible parts (seed, bone, etc)
-    "refuse",  # percentage of refuse
-    "scientific_name",  # generally for least processed, raw form if applicable
-    "n_factor",  # factor for nitrogen to protein
-    "protein_factor",  # factor for calories from protein
-    "fat_factor",  # factor for calories from fat
-    "carb_factor",  # factor for calories from carbohydrates
+CodeDesc = record_type("CodeDesc", [
+    Field("key", TEXT, False),
+    Field("val", TEXT, False),
 ])
+lookup_recs = functools.partial(nndb_recs, field_names=CodeDesc.doc_fields)
+
+
+FoodDes = record_type("FoodDes", [
+    Field("_id", TEXT, False),  # aka NDB_No
+    Field("food_group_code", TEXT, False, shared=True),  # references the food group descriptions
+    Field("descrip", TEXT, False),
+    Field("short_descrip", TEXT, False),
+    Field("common_name", TEXT, True),
+    Field("mfg_name", TEXT, True),
+    Field("survey", TEXT, True, shared=True),  # if used in FNDDS (if so, nutrient data should be complete)
+    Field("refuse_descrip", TEXT, True),  # description of inedible parts (seed, bone, etc)
+    Field("refuse", TEXT, True),  # percentage of refuse
+    Field("scientific_name", TEXT, True),  # generally for least processed, raw form if applicable
+    Field("n_factor", FLOAT, True),  # factor for nitrogen to protein
+    Field("protein_factor", FLOAT, True),  # factor for calories from protein
+    Field("fat_factor", FLOAT, True),  # factor for calories from fat
+    Field("carb_factor", FLOAT, True),  # factor for calories from carbohydrates
+])
+food_des_recs = functools.partial(nndb_recs, field_names=FoodDes.doc_fields)
+
+
+NutData = record_type("NutData", [
+    Field("ndb_num", TEXT, False, shared=True),  # aka NDB_No, the _id to FOOD_DES
+    Field("nutrient_id", TEXT, False, shared=True),  # aka Nutr_No
+    Field("nutrient_val", FLOAT, False),  # Num edible portion in 100g
+    Field("data_point_count", FLOAT, False),  # Num data points used for analysis
+    Field("std_error", FLOAT, True),  # std err of mean, can be null (if data_point_count < 3)
+    Field("source_code", TEXT, False, shared=True),
+    Field("derivation_code", TEXT, True, shared=True),
+    Field("ref_nbd_id", TEXT, True, shared=True),  # May refer to another item used to calc a missing value
+    Field("add_nutrition_mark", TEXT, True, shared=True),  # Used for fortified cereals
+    Field("num_studies", FLOAT, True),  # Num
+    Field("min_value", FLOAT, True),  # Num
+    Field("max_value", FLOAT, True),  # Num
+    Field("degrees_freedom", FLOAT, True),  # Num
+    Field("lower_err_bound", FLOAT, True),  # Num - lower 95% error bound
+    Field("upper_err_bound", FLOAT, True),  # Num - lower 95% error bound
+    Field("statistical_comments", TEXT, True, shared=True),
+    Field("confidence_code", TEXT, True, shared=True),  # Indicates overall assessment of quality
+])
+nut_data_recs = functools.partial(nndb_recs, field_names=NutData.doc_fields)
 
 
-nut_data_recs = functools.partial(nndb_recs, field_names=[
-    "ndb_num",  # aka NDB_No, the _id to FOOD_DES
-    "nutrient_id",  # aka Nutr_No
-    "nutrient_val",  # Num edible portion in 100g
-    "data_point_count",  # Num data points used for analysis
-    "std_error",  # std err of mean, can be null (if data_point_count < 3)
-    "source_code",
-    "derivation_code",
-    "ref_nbd_id",  # May refer to another item used to calc a missing value
-    "add_nutrition_mark",  # Used for fortified cereals
-    "num_studies",  # Num
-    "min_value",  # Num
-    "max_value",  # Num
-    "degrees_freedom",  # Num
-    "lower_err_bound",  # Num - lower 95% error bound
-    "upper_err_bound",  # Num - lower 95% error bound
-    "statistical_comments",
-    "confidence_code",  # Indicates overall assessment of quality
+NutrDef = record_type("NutrDef", [
+    Field("nutrient_id", TEXT, False),  # aka Nutr_No
+    Field("units", TEXT, False),  # mg, g, lb, etc
+    Field("tagname", TEXT, True),  # INFOODS tag
+    Field("descrip", TEXT, False),
+    Field("decimal_places", TEXT, False),
+    Field("sr_sort_order", TEXT, False),  # num
 ])
+nutr_def_recs = functools.partial(nndb_recs, field_names=NutrDef.doc_fields)
 
 
-nutr_def_recs = functools.partial(nndb_recs, field_names=[
-    "nutrient_id",  # aka Nutr_No
-    "units",  # mg, g, lb, etc
-    "tagname",  # INFOODS tag
-    "descrip",
-    "decimal_places",
-    "sr_sort_order",  # num
+Weight = record_type("Weight", [
+    Field("ndb_num", TEXT, False, shared=True),
+    Field("seq", TEXT, False, shared=True),
+    Field("amount", TEXT, False, shared=True),
+    Field("descrip", TEXT, False, shared=True),
+    Field("gram_weight", TEXT, False),
+    Field("num_data_points", TEXT, True),
+    Field("stddev", TEXT, True),
 ])
 
 
+Langual = record_type("Langual", [
+    Field("ndb_num", TEXT, False, shared=True),
+    Field("code", TEXT, False, shared=True),
+])
+
+
+LangDesc = record_type("LangDesc", [
+    Field("code", TEXT, False),
+    Field("descrip", TEXT, False),
+])
+
+
+Footnote = record_type("Footnote", [
+    Field("ndb_num", TEXT, False, shared=True),
+    Field("footnote_num", TEXT, False, shared=True),
+    Field("footnote_type", TEXT, False, shared=True),
+    Field("nutr_num", TEXT, True, shared=True),
+    Field("text", TEXT, False),
+])
+
+
+DataSrc = record_type("DataSrc", [
+    Field("datasrc_id", TEXT, False),
+    Field("authors", TEXT, True),
+    Field("title", TEXT, False),
+    Field("year", TEXT, True),
+    Field("journal", TEXT, True),
+    Field("vol_city", TEXT, True),
+    Field("issue_state", TEXT, True),
+    Field("start_page", TEXT, True),
+    Field("end_page", TEXT, True),
+])
+
+
+DatSrcLn = record_type("DatSrcLn", [
+    Field("ndb_num", TEXT, False, shared=True),
+    Field("nutr_num", TEXT, False, shared=True),
+    Field("datasrc_id", TEXT, False, shared=True),
+])
+
+
+# Every file we read and its record type
+SR_FILES = collections.OrderedDict([
+    ("FD_GROUP.txt", CodeDesc),
+    ("LANGDESC.txt", LangDesc),
+    ("SRC_CD.txt", CodeDesc),
+    ("DERIV_CD.txt", CodeDesc),
+    ("DATA_SRC.txt", DataSrc),
+    ("NUTR_DEF.txt", NutrDef),
+    ("FOOD_DES.txt", FoodDes),
+    ("WEIGHT.txt", Weight),
+    ("LANGUAL.txt", Langual),
+    ("FOOTNOTE.txt", Footnote),
+    ("DATSRCLN.txt", DatSrcLn),
+    ("NUT_DATA.txt", NutData),
+])
+
+
+# Target size of the byte ranges a file is split in to for parallel parsing
+PARSE_CHUNK_BYTES = 1 << 20
+
+
+def file_chunks(filename, chunk_bytes=PARSE_CHUNK_BYTES):
+    """Split filename in to a list of (start, end) byte ranges of about
+    chunk_bytes each, with every range ending on a line boundary"""
+    size = os.path.getsize(filename)
+    chunks = []
+    with open(filename, "rb") as datafile:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end < size:
+                datafile.seek(end)
+                datafile.readline()  # Finish the line we landed in
+                end = datafile.tell()
+            end = min(end, size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_range(filename, record_cls, start, end):
+    """Parse the lines in the byte range [start, end) of filename with
+    bytes_fields, but return a list of plain field tuples which are much
+    cheaper to send between processes than records or dicts"""
+    with open(filename, "rb") as datafile:
+        datafile.seek(start)
+        data = datafile.read(end - start)
+
+    rows, memo = [], {}
+    for line in io.BytesIO(data):
+        flds = bytes_fields(line, record_cls, memo)
+        if flds is not None:
+            rows.append(tuple(flds))
+    return rows
+
+
+# Record parsers for SRDirectory: the text mode one matches nndb_recs line
+# for line, the mmap one is the bytes level fast path
+PARSERS = {
+    "text": nndb_tuples,
+    "mmap": mmap_tuples,
+}
+
+
+class SRDirectory(object):
+    """A directory of SR ASCII files, parsed serially by one of PARSERS"""
+
+    def __init__(self, dirname, parser="mmap"):
+        self.dirname = dirname
+        self.parser = PARSERS[parser]
+
+    def path(self, filename):
+        return os.path.join(self.dirname, filename)
+
+    def source(self, filename):
+        """(file on disk, archive member or None) holding filename"""
+        return self.path(filename), None
+
+    def size(self, filename):
+        """Size of the data in filename in bytes"""
+        return os.path.getsize(self.path(filename))
+
+    def records(self, filename):
+        """Iterator over the records (of the SR_FILES record type) in filename"""
+        return self.parser(self.path(filename), SR_FILES[filename])
+
+    def recs(self, filename):
+        """Iterator over the records in filename as dictionaries"""
+        return (rec.as_dict() for rec in self.records(filename))
+
+    def prefetch(self, filenames=None):
+        """Serial parsing has nothing to start ahead of time"""
+        pass
+
+
+class ParallelSRDirectory(SRDirectory):
+    """A directory of SR ASCII files parsed by a process pool. Every file is
+    split in to line-aligned byte ranges (so the small lookup files are a
+    single task and NUT_DATA is many) and the workers send back compact
+    tuple batches. Note that prefetched results are held until read."""
+
+    def __init__(self, dirname, pool, chunk_bytes=PARSE_CHUNK_BYTES):
+        super(ParallelSRDirectory, self).__init__(dirname)
+        self.pool = pool
+        self.chunk_bytes = chunk_bytes
+        self.pending = {}
+
+    def submit(self, filename):
+        """Queue every chunk of filename on the pool"""
+        path, record_cls = self.path(filename), SR_FILES[filename]
+        self.pending[filename] = [
+            self.pool.submit(parse_range, path, record_cls, start, end)
+            for start, end in file_chunks(path, self.chunk_bytes)
+        ]
+
+    def prefetch(self, filenames=None):
+        """Fan all (or the given) files out to the pool at once"""
+        for filename in (SR_FILES.keys() if filenames is None else filenames):
+            self.submit(filename)
+
+    def records(self, filename):
+        if filename not in self.pending:
+            self.submit(filename)
+        futures = self.pending.pop(filename)
+        make = SR_FILES[filename]._make
+
+        # Chunks are consumed in file order, so sort order is preserved
+        for future in futures:
+            for row in future.result():
+                yield make(row)
+
+
+# Size of the blocks read from (and decompressed out of) an archive member
+ARCHIVE_BLOCK_BYTES = 1 << 20
+
+
+def archive_members(archive):
+    """Map every SR_FILES name to the member of archive (a zip or tar file)
+    holding it. Members may be in a subdirectory and their names are
+    matched regardless of case, since USDA's archives vary."""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zipped:
+            names = zipped.namelist()
+    else:
+        with tarfile.open(archive, "r:*") as tarred:
+            names = [info.name for info in tarred.getmembers() if info.isfile()]
+
+    by_name = dict((os.path.basename(name).lower(), name) for name in names)
+    return dict(
+        (filename, by_name[filename.lower()])
+        for filename in SR_FILES
+        if filename.lower() in by_name
+    )
+
+
+def archive_lines(archive, member):
+    """The raw lines of member in archive, decompressed a block at a time
+    straight from the archive (nothing is extracted to disk)"""
+    if zipfile.is_zipfile(archive):
+        container = zipfile.ZipFile(archive)
+        data = container.open(member)
+    else:
+        container = tarfile.open(archive, "r:*")
+        data = container.extractfile(member)
+
+    with container, data:
+        rest = b""
+        for block in iter(functools.partial(data.read, ARCHIVE_BLOCK_BYTES), b""):
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+
+def parse_member(archive, member, record_cls):
+    """parse_range for a whole archive member: a list of field tuples"""
+    rows, memo = [], {}
+    for line in archive_lines(archive, member):
+        flds = bytes_fields(line, record_cls, memo)
+        if flds is not None:
+            rows.append(tuple(flds))
+    return rows
+
+
+class ArchiveSRDirectory(SRDirectory):
+    """The SR files in a release archive (zip, tar or tar.gz), parsed at
+    the bytes level (see bytes_fields) as they are decompressed. Given a
+    process pool, prefetch() decompresses and parses the members of a zip
+    in parallel, one task per member. A tar file is a single stream, so
+    its members are always read in turn."""
+
+    def __init__(self, archive, pool=None):
+        super(ArchiveSRDirectory, self).__init__(archive)
+        self.archive = archive
+        self.members = archive_members(archive)
+        self.pool = pool if zipfile.is_zipfile(archive) else None
+        self.pending = {}
+        self.sizes = None
+
+    def path(self, filename):
+        """Every file comes from (and is identified by) the archive"""
+        return self.archive
+
+    def source(self, filename):
+        return self.archive, self.member(filename)
+
+    def member(self, filename):
+        if filename not in self.members:
+            raise ValueError("There is no %s in %s" % (filename, self.archive))
+        return self.members[filename]
+
+    def size(self, filename):
+        """Uncompressed size of the member, all read in one go (finding a
+        member of a tar.gz means decompressing everything before it)"""
+        if self.sizes is None:
+            if zipfile.is_zipfile(self.archive):
+                with zipfile.ZipFile(self.archive) as zipped:
+                    self.sizes = dict((info.filename, info.file_size) for info in zipped.infolist())
+            else:
+                with tarfile.open(self.archive, "r:*") as tarred:
+                    self.sizes = dict((info.name, info.size) for info in tarred.getmembers())
+        return self.sizes[self.member(filename)]
+
+    def prefetch(self, filenames=None):
+        if self.pool is None:
+            return
+        for filename in (SR_FILES.keys() if filenames is None else filenames):
+            self.pending[filename] = self.pool.submit(
+                parse_member, self.archive, self.member(filename), SR_FILES[filename]
+            )
+
+    def records(self, filename):
+        make = SR_FILES[filename]._make
+        if filename in self.pending:
+            for row in self.pending.pop(filename).result():
+                yield make(row)
+            return
+
+        memo = {}
+        for line in archive_lines(self.archive, self.member(filename)):
+            flds = bytes_fields(line, SR_FILES[filename], memo)
+            if flds is not None:
+                yield make(flds)
+
+
+def open_release(path, parser="mmap", pool=None):
+    """The SRDirectory for path: a directory of SR files, parsed by pool if
+    given, or a release archive (see ArchiveSRDirectory)"""
+    if not os.path.isdir(path):
+        return ArchiveSRDirectory(path, pool)
+    if pool is not None:
+        return ParallelSRDirectory(path, pool)
+    return SRDirectory(path, parser)
+
+
+# Every reference between SR files as (file, fields, referenced file,
+# referenced fields). Empty values of nullable fields reference nothing.
+FOREIGN_KEYS = [
+    ("FOOD_DES.txt", ("food_group_code",), "FD_GROUP.txt", ("key",)),
+    ("WEIGHT.txt", ("ndb_num",), "FOOD_DES.txt", ("_id",)),
+    ("LANGUAL.txt", ("ndb_num",), "FOOD_DES.txt", ("_id",)),
+    ("LANGUAL.txt", ("code",), "LANGDESC.txt", ("code",)),
+    ("FOOTNOTE.txt", ("ndb_num",), "FOOD_DES.txt", ("_id",)),
+    ("FOOTNOTE.txt", ("nutr_num",), "NUTR_DEF.txt", ("nutrient_id",)),
+    ("NUT_DATA.txt", ("ndb_num",), "FOOD_DES.txt", ("_id",)),
+    ("NUT_DATA.txt", ("nutrient_id",), "NUTR_DEF.txt", ("nutrient_id",)),
+    ("NUT_DATA.txt", ("source_code",), "SRC_CD.txt", ("key",)),
+    ("NUT_DATA.txt", ("derivation_code",), "DERIV_CD.txt", ("key",)),
+    ("DATSRCLN.txt", ("ndb_num",), "FOOD_DES.txt", ("_id",)),
+    ("DATSRCLN.txt", ("ndb_num", "nutr_num"), "NUT_DATA.txt", ("ndb_num", "nutrient_id")),
+    ("DATSRCLN.txt", ("datasrc_id",), "DATA_SRC.txt", ("datasrc_id",)),
+]
+
+# Number of orphan rows validate_release keeps for every foreign key
+VALIDATE_SAMPLES = 5
+
+
+def key_getter(record_cls, fields):
+    """A function returning the key of fields from a record_cls record: the
+    value for a single field, a tuple of them for more"""
+    return operator.itemgetter(*[record_cls.doc_fields.index(f) for f in fields])
+
+
+def validate_release(release, samples=VALIDATE_SAMPLES):
+    """Check every FOREIGN_KEYS reference in release without building any
+    documents: each file is read once, referenced files first, keeping only
+    its key columns in sets. Prints the orphans (with up to samples of their
+    rows) and duplicate keys found, and returns the number of problems."""
+    start = time.perf_counter()
+    order = []
+
+    def visit(filename):
+        for child, fields, parent, parent_fields in FOREIGN_KEYS:
+            if child == filename and parent not in order:
+                visit(parent)
+        if filename not in order:
+            order.append(filename)
+    for filename in SR_FILES:
+        visit(filename)
+
+    referenced = set((parent, parent_fields) for child, fields, parent, parent_fields in FOREIGN_KEYS)
+    keys = dict()  # (file, fields) => set of keys
+    problems = 0
+    for filename in order:
+        record_cls = SR_FILES[filename]
+        collect = [
+            (fields, key_getter(record_cls, fields), set(), [0])
+            for parent, fields in sorted(referenced) if parent == filename
+        ]
+        checks = [
+            (fields, parent, key_getter(record_cls, fields), keys[parent, parent_fields], [
+                i for i, fld in enumerate(record_cls.schema) if fld.name in fields and fld.nullable
+            ], [0], [])
+            for child, fields, parent, parent_fields in FOREIGN_KEYS if child == filename
+        ]
+
+        count = 0
+        for rec in release.records(filename):
+            count += 1
+            for fields, key, seen, dups in collect:
+                k = key(rec)
+                if k in seen:
+                    dups[0] += 1
+                seen.add(k)
+            for fields, parent, key, refs, optional, orphans, rows in checks:
+                if key(rec) in refs or any(not rec[i] for i in optional):
+                    continue
+                orphans[0] += 1
+                if len(rows) < samples:
+                    rows.append(rec)
+
+        for fields, key, seen, dups in collect:
+            keys[filename, fields] = seen
+            if dups[0]:
+                print("%-13s %d duplicate %s" % (filename, dups[0], "+".join(fields)))
+                problems += dups[0]
+        for fields, parent, key, refs, optional, orphans, rows in checks:
+            print("%-13s %-22s -> %-13s %8d rows %6d orphans" % (
+                filename, "+".join(fields), parent, count, orphans[0]
+            ))
+            problems += orphans[0]
+            for rec in rows:
+                print("    %s" % "^".join(str(v) for v in rec))
+
+    print("...Validated %d files in %.3fs: %d problems" % (len(order), time.perf_counter() - start, problems))
+    return problems
+
+
+# Bump when the cache file format changes so old entries are ignored
+CACHE_VERSION = 1
+
+# Number of rows pickled together in a cache file
+CACHE_BATCH_ROWS = 10000
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nndb-import")
+
+
+def file_sha1(filename):
+    """Hex SHA-1 of the contents of filename"""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as datafile:
+        for block in iter(functools.partial(datafile.read, 1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def replacing(path, mode="w"):
+    """Open a temp file to write path through: it is renamed over path when
+    the with block succeeds and removed if it raises, so path is never
+    left half written"""
+    tmp_fn = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_fn, mode) as out:
+            yield out
+        os.replace(tmp_fn, path)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+
+class WrappedSRDirectory(SRDirectory):
+    """Base for the SRDirectory wrappers: whatever a subclass doesn't
+    override is passed on to inner"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.dirname = inner.dirname
+
+    def path(self, filename):
+        return self.inner.path(filename)
+
+    def source(self, filename):
+        return self.inner.source(filename)
+
+    def size(self, filename):
+        return self.inner.size(filename)
+
+    def records(self, filename):
+        return self.inner.records(filename)
+
+    def prefetch(self, filenames=None):
+        self.inner.prefetch(filenames)
+
+
+class CachedSRDirectory(WrappedSRDirectory):
+    """Wraps another SRDirectory and keeps every table it parses in
+    cache_dir as batches of pickled tuples. A table is keyed by the SHA-1 of
+    its data file plus its record schema, so any release (or schema change)
+    gets its own entries. manifest.json remembers the size, mtime and hash
+    of every file seen so unchanged files aren't re-hashed. With rebuild
+    every table is parsed and written again, once: later reads in the same
+    run use the new entry. Every read that parses writes its own temp file,
+    so tables read at the same time (as push mode phases do) don't clash."""
+
+    def __init__(self, inner, cache_dir=DEFAULT_CACHE_DIR, rebuild=False):
+        super(CachedSRDirectory, self).__init__(inner)
+        self.cache_dir = cache_dir
+        self.rebuild = rebuild
+        self.rebuilt = set()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.manifest_fn = os.path.join(cache_dir, "manifest.json")
+        self.manifest_lock = threading.Lock()
+        self.manifest = dict()
+        if os.path.exists(self.manifest_fn):
+            with open(self.manifest_fn, "r") as manifest:
+                self.manifest = json.load(manifest)
+
+    def source_sha1(self, filename):
+        """SHA-1 of the data file, from the manifest if it hasn't changed.
+        For a member of an archive it's the SHA-1 of the archive's SHA-1 and
+        the member name, so the archive is the key for all its tables."""
+        path, member = self.source(filename)
+        sha1 = self.file_sha1(os.path.abspath(path))
+        if member is not None:
+            sha1 = hashlib.sha1(("%s:%s" % (sha1, member)).encode("utf-8")).hexdigest()
+        return sha1
+
+    def file_sha1(self, path):
+        """SHA-1 of the file path, from the manifest if it hasn't changed"""
+        st = os.stat(path)
+        seen = self.manifest.get(path)
+        if seen and seen["size"] == st.st_size and seen["mtime_ns"] == st.st_mtime_ns:
+            return seen["sha1"]
+
+        sha1 = file_sha1(path)
+        with self.manifest_lock:  # push mode phases may run at once
+            self.manifest[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": sha1}
+            with replacing(self.manifest_fn) as manifest:
+                json.dump(self.manifest, manifest, indent=1, sort_keys=True)
+        return sha1
+
+    def cache_path(self, filename):
+        record_cls = SR_FILES[filename]
+        schema_key = hashlib.sha1(repr((CACHE_VERSION, record_cls.schema)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "%s-%s-%s.pickle" % (
+            self.source_sha1(filename), record_cls.__name__, schema_key[:12]
+        ))
+
+    def is_cached(self, filename):
+        cache_fn = self.cache_path(filename)
+        return (not self.rebuild or cache_fn in self.rebuilt) and os.path.exists(cache_fn)
+
+    def prefetch(self, filenames=None):
+        """Only the tables we don't have need to be parsed"""
+        self.inner.prefetch([
+            filename
+            for filename in (SR_FILES.keys() if filenames is None else filenames)
+            if not self.is_cached(filename)
+        ])
+
+    def records(self, filename):
+        cache_fn = self.cache_path(filename)
+        make = SR_FILES[filename]._make
+
+        if self.is_cached(filename):
+            print("  (using cached %s)" % filename)
+            with open(cache_fn, "rb") as cachefile:
+                while True:
+                    try:
+                        batch = pickle.load(cachefile)
+                    except EOFError:
+                        break
+                    for row in batch:
+                        yield make(row)
+            return
+
+        # Only a fully read table is cached: the temp file is dropped if
+        # we are abandoned part way through
+        fd, tmp_fn = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as cachefile:
+                batch = []
+                for rec in self.inner.records(filename):
+                    batch.append(tuple(rec))
+                    yield rec
+                    if len(batch) >= CACHE_BATCH_ROWS:
+                        pickle.dump(batch, cachefile, pickle.HIGHEST_PROTOCOL)
+                        batch = []
+                if batch:
+                    pickle.dump(batch, cachefile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fn, cache_fn)
+            self.rebuilt.add(cache_fn)
+        finally:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+
+
 def num(s, filt=float):
     """Helper for numeric fields - we accept a string, convert it using filt,
     and will return an empty string if there is a ValueError converting
@@ -186,213 +936,2554 @@ def nums(rec, field_names, filt=float):
         rec[fn] = num(rec.get(fn, ""), filt=filt)
 
 
-def process_directory(mongo, dirname):  #NOQA (ignore McCabe for this func)
-    """Process single directory"""
-    # Shorten our code a little
-    def get_fn(fn):
-        return os.path.join(dirname, fn)
+# All the code => description files the principal files reference
+SRLookups = collections.namedtuple("SRLookups", [
+    "food_grp_codes",
+    "langual_codes",
+    "src_codes",
+    "deriv_codes",
+    "data_srcs",
+    "nutr_defs",
+    "nutrient_order",  # nutrient ids for NUTRIENT_VECTOR_FIELD, None for no vectors
+])
+
 
-    # Read in various dictionaries we need first
+def load_lookups(release):
+    """Read all the (small) lookup files in release and return an SRLookups"""
     print("Reading food group codes")
-    food_grp_codes = recs_to_lookup(get_fn("FD_GROUP.txt"))
+    food_grp_codes = pairs_to_lookup(release.recs("FD_GROUP.txt"))
 
     print("Reading LanguaL codes")
-    langual_codes = recs_to_dict(
-        "code",
-        nndb_recs(get_fn("LANGDESC.txt"), ["code", "descrip"])
-    )
+    langual_codes = recs_to_dict("code", release.recs("LANGDESC.txt"))
     langual_codes[""] = ""
 
-    # Clearing previous entries
-    print("Clearing database")
-    bulk = mongo.initialize_ordered_bulk_op()
-    bulk.find({}).remove()
-    report_bulk(bulk.execute())
+    print("Reading source code descrips")
+    src_codes = pairs_to_lookup(release.recs("SRC_CD.txt"))
+
+    print("Reading data derivation code descrips")
+    deriv_codes = pairs_to_lookup(release.recs("DERIV_CD.txt"))
+
+    print("Reading data sources for footnotes")
+    data_srcs = recs_to_dict("datasrc_id", release.recs("DATA_SRC.txt"))
+
+    print("Reading nutrient defs...")
+    nutr_defs = recs_to_dict("nutrient_id", release.recs("NUTR_DEF.txt"))
+
+    return SRLookups(
+        food_grp_codes=food_grp_codes,
+        langual_codes=langual_codes,
+        src_codes=src_codes,
+        deriv_codes=deriv_codes,
+        data_srcs=data_srcs,
+        nutr_defs=nutr_defs,
+        nutrient_order=None,
+    )
+
+
+def food_entry(rec, lookups):
+    """Turn a FOOD_DES record into a food document with empty arrays for the
+    other principal files to fill in"""
+    entry = rec.as_dict()
+
+    # Just in case we ever decide to use something else for _id
+    entry['ndb_num'] = entry['_id']
+
+    # Setup defaults
+    entry.update({
+        'nutrients': list(),
+        'food_group_descrip': lookups.food_grp_codes[entry["food_group_code"]],
+        'footnotes': list(),
+        'langual_entries': list(),
+        'measures': list(),
+    })
+    return entry
+
+
+def weight_entry(rec, lookups):
+    """WEIGHT records are stored as-is in measures"""
+    return rec.as_dict()
+
+
+def langual_entry(rec, lookups):
+    """LANGUAL records are replaced by their LANGDESC code/descrip"""
+    return lookups.langual_codes[rec.code]
+
+
+def footnote_entry(rec, lookups):
+    """FOOTNOTE records are stored as-is with a type marker"""
+    entry = rec.as_dict()
+    entry["type"] = "footnote"
+    return entry
+
+
+def datasrc_entry(rec, lookups):
+    """DATSRCLN records become footnotes carrying the full DATA_SRC citation"""
+    entry = rec.as_dict()
+    entry.update(lookups.data_srcs[rec.datasrc_id])
+    entry["type"] = "data-source"
+    return entry
+
+
+def nutrient_entry(rec, lookups):
+    """NUT_DATA records get code descriptions and the nutrient definition"""
+    entry = rec.as_dict()
+
+    # Add descriptions for the codes we know
+    entry["source_descrip"] = lookups.src_codes[entry["source_code"]]
+    entry["derivation_descrip"] = lookups.deriv_codes[entry["derivation_code"]]
+
+    # Just add the nutrient def info to the entry
+    xtra = lookups.nutr_defs[entry["nutrient_id"]]
+    entry.update(xtra)
+
+    # Ensure units are the way we want them
+    entry["units"] = UNIT_REPLACEMENTS.get(entry["units"], entry["units"])
+    return entry
+
+
+# The principal files that fill in the arrays of a food document, in the
+# order they are applied: (file name, array field, builder)
+FOOD_ARRAYS = [
+    ("WEIGHT.txt", "measures", weight_entry),
+    ("LANGUAL.txt", "langual_entries", langual_entry),
+    ("FOOTNOTE.txt", "footnotes", footnote_entry),
+    ("DATSRCLN.txt", "footnotes", datasrc_entry),
+    ("NUT_DATA.txt", "nutrients", nutrient_entry),
+]
+
+
+def food_document(food_rec, children, lookups):
+    """Build the complete food document for a FOOD_DES record given a list
+    of its child records for each of FOOD_ARRAYS. This is the only place
+    joined records become dictionaries."""
+    food = food_entry(food_rec, lookups)
+    for (filename, field, build), recs in zip(FOOD_ARRAYS, children):
+        food[field].extend(build(rec, lookups) for rec in recs)
+    if lookups.nutrient_order is not None:
+        food[NUTRIENT_VECTOR_FIELD] = nutrient_vector(food["nutrients"], lookups.nutrient_order)
+    return food
+
 
+# The optional packed nutrient values of a food, and the _id of the
+# document in <collection>.meta describing them
+NUTRIENT_VECTOR_FIELD = "nutrient_vector"
+NUTRIENT_VECTOR_DTYPE = "<f4"
+
+
+def vector_nutrients(release):
+    """The NUTR_DEF records of release in the order nutrient vectors use:
+    USDA's SR_Order, then nutrient id"""
+    return sorted(
+        release.recs("NUTR_DEF.txt"),
+        key=lambda nutr_def: (num(nutr_def["sr_sort_order"]) or 0.0, nutr_def["nutrient_id"])
+    )
+
+
+def nutrient_vector(nutrients, order):
+    """Pack the nutrient_val of every nutrient id in order as a little
+    endian float32 binary, with NaN for the ones the food doesn't have"""
+    values = dict((entry["nutrient_id"], entry["nutrient_val"]) for entry in nutrients)
+    packed = []
+    for nutrient_id in order:
+        value = values.get(nutrient_id)
+        packed.append(value if isinstance(value, float) else float("nan"))
+    return bson.binary.Binary(struct.pack("<%df" % len(packed), *packed))
+
+
+def save_vector_meta(mongo, nutr_defs):
+    """Describe the nutrient vectors of the foods in mongo (see
+    vector_nutrients) in <collection>.meta"""
+    mongo.meta.replace_one({'_id': NUTRIENT_VECTOR_FIELD}, {
+        '_id': NUTRIENT_VECTOR_FIELD,
+        'dtype': NUTRIENT_VECTOR_DTYPE,
+        'missing': "NaN",
+        'nutrient_ids': [nutr_def["nutrient_id"] for nutr_def in nutr_defs],
+        'units': [UNIT_REPLACEMENTS.get(nutr_def["units"], nutr_def["units"]) for nutr_def in nutr_defs],
+        'tagnames': [nutr_def["tagname"] for nutr_def in nutr_defs],
+    }, upsert=True)
+
+
+def load_nutrient_matrix(mongo, query=None):
+    """Read the nutrient vectors of the foods in mongo matching query in to
+    a foods x nutrients numpy array. Returns (NDB numbers, nutrient ids,
+    array). Needs numpy and an import done with vectors."""
+    import numpy
+    meta = mongo.meta.find_one({'_id': NUTRIENT_VECTOR_FIELD})
+    if meta is None:
+        raise ValueError("%s has no nutrient vectors" % mongo.name)
+    ndb_nums, rows = [], []
+    for doc in mongo.find(query or {}, {NUTRIENT_VECTOR_FIELD: True}):
+        ndb_nums.append(doc['_id'])
+        rows.append(numpy.frombuffer(doc[NUTRIENT_VECTOR_FIELD], dtype=meta["dtype"]))
+    matrix = numpy.vstack(rows) if rows else numpy.zeros((0, len(meta["nutrient_ids"])), dtype=meta["dtype"])
+    return ndb_nums, meta["nutrient_ids"], matrix
+
+
+# The files write_nutrient_matrix puts in its directory: the matrix, then
+# the row (NDB_No) and column (nutrient_id) indexes, one id per line
+NUTRIENT_MATRIX_FILES = ("nutrients.npy", "ndb_nos.txt", "nutrient_ids.txt")
+
+
+def write_nutrient_matrix(release, path):
+    """Write the foods x nutrients matrix of release to the directory path
+    as NUTRIENT_MATRIX_FILES. Rows follow FOOD_DES, columns follow
+    vector_nutrients, and values are NUTRIENT_VECTOR_DTYPE with NaN for
+    nutrients a food doesn't have. Needs numpy."""
+    try:
+        import numpy
+    except ImportError:
+        sys.stderr.write("\n\nCould not import numpy - it is required for the nutrient matrix\n\n")
+        raise
+
+    ndb_nums = [rec.id for rec in release.records("FOOD_DES.txt")]
+    nutrient_ids = [nutr_def["nutrient_id"] for nutr_def in vector_nutrients(release)]
+    rows = dict((ndb_num, i) for i, ndb_num in enumerate(ndb_nums))
+    cols = dict((nutrient_id, j) for j, nutrient_id in enumerate(nutrient_ids))
+
+    matrix = numpy.full((len(ndb_nums), len(nutrient_ids)), numpy.nan, dtype=NUTRIENT_VECTOR_DTYPE)
+    for rec in release.records("NUT_DATA.txt"):
+        if isinstance(rec.nutrient_val, float) and rec.ndb_num in rows and rec.nutrient_id in cols:
+            matrix[rows[rec.ndb_num], cols[rec.nutrient_id]] = rec.nutrient_val
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    matrix_fn, rows_fn, cols_fn = [os.path.join(path, name) for name in NUTRIENT_MATRIX_FILES]
+    for fn, write in [
+        (matrix_fn, lambda f: numpy.save(f, matrix)),
+        (rows_fn, lambda f: f.write("".join(n + "\n" for n in ndb_nums).encode("ascii"))),
+        (cols_fn, lambda f: f.write("".join(n + "\n" for n in nutrient_ids).encode("ascii"))),
+    ]:
+        with replacing(fn, "wb") as f:
+            write(f)
+    print("Wrote %d x %d nutrient matrix to %s" % (len(ndb_nums), len(nutrient_ids), matrix_fn))
+
+
+def open_nutrient_matrix(path):
+    """Open a matrix written by write_nutrient_matrix without reading it:
+    returns (NDB numbers, nutrient ids, read only memory mapped array)"""
+    import numpy
+    matrix_fn, rows_fn, cols_fn = [os.path.join(path, name) for name in NUTRIENT_MATRIX_FILES]
+    with open(rows_fn, encoding="ascii") as f:
+        ndb_nums = f.read().split()
+    with open(cols_fn, encoding="ascii") as f:
+        nutrient_ids = f.read().split()
+    return ndb_nums, nutrient_ids, numpy.load(matrix_fn, mmap_mode="r")
+
+
+# Per nutrient statistics go to this collection in the target database,
+# one document per collection and nutrient
+STATS_COLLECTION = "nndb_stats"
+STATS_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+STATS_INDEXES = [
+    ("collection_nutrient", [("collection", pymongo.ASCENDING), ("nutrient_id", pymongo.ASCENDING)]),
+    ("collection_tagname", [("collection", pymongo.ASCENDING), ("tagname", pymongo.ASCENDING)]),
+]
+SKETCH_ACCURACY = 0.01
+
+
+class QuantileSketch(object):
+    """Approximate quantiles with accuracy relative error (the DDSketch
+    idea): every value is counted in the logarithmic bucket it falls in,
+    so sketches of separate parts of the data merge by adding counts.
+    Zeros, which SR has plenty of, get a count of their own."""
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.zeros = 0
+        self.bins = collections.Counter()  # bucket -> count for values > 0
+        self.neg_bins = collections.Counter()  # the same for -value < 0
+
+    def bucket(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value):
+        if value > 0.0:
+            self.bins[self.bucket(value)] += 1
+        elif value < 0.0:
+            self.neg_bins[self.bucket(-value)] += 1
+        else:
+            self.zeros += 1
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can't merge sketches of accuracy %r and %r" % (self.accuracy, other.accuracy))
+        self.zeros += other.zeros
+        self.bins.update(other.bins)
+        self.neg_bins.update(other.neg_bins)
+        return self
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.bins.values()) + sum(self.neg_bins.values())
+
+    def bin_value(self, i):
+        """The value bin i stands for: the midpoint (in relative error) of
+        the values it holds"""
+        return 2.0 * self.gamma ** i / (self.gamma + 1.0)
+
+    def quantile(self, q):
+        """The approximate q quantile (0 <= q <= 1), None with no values"""
+        count = self.count
+        if not count:
+            return None
+        rank = q * (count - 1)
+        seen = 0
+        for i in sorted(self.neg_bins, reverse=True):
+            seen += self.neg_bins[i]
+            if seen > rank:
+                return -self.bin_value(i)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                return self.bin_value(i)
+        return self.bin_value(max(self.bins))
+
+    def as_doc(self):
+        return {
+            'accuracy': self.accuracy,
+            'zeros': self.zeros,
+            'bins': [[i, n] for i, n in sorted(self.bins.items())],
+            'neg_bins': [[i, n] for i, n in sorted(self.neg_bins.items())],
+        }
+
+    @classmethod
+    def from_doc(cls, doc):
+        sketch = cls(doc["accuracy"])
+        sketch.zeros = doc["zeros"]
+        sketch.bins.update(dict((i, n) for i, n in doc["bins"]))
+        sketch.neg_bins.update(dict((i, n) for i, n in doc["neg_bins"]))
+        return sketch
+
+
+class NutrientStat(object):
+    """Streaming statistics of one nutrient's values: count, mean and
+    variance (Welford), the foods with the smallest and largest value and a
+    QuantileSketch. merge() combines the stats of two parts of the data."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = self.max = None
+        self.min_ndb_num = self.max_ndb_num = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value, ndb_num):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min, self.min_ndb_num = value, ndb_num
+        if self.max is None or value > self.max:
+            self.max, self.max_ndb_num = value, ndb_num
+        self.sketch.add(value)
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        if self.min is None or other.min < self.min:
+            self.min, self.min_ndb_num = other.min, other.min_ndb_num
+        if self.max is None or other.max > self.max:
+            self.max, self.max_ndb_num = other.max, other.max_ndb_num
+        self.sketch.merge(other.sketch)
+        return self
+
+    def as_doc(self):
+        """The statistics as (part of) a STATS_COLLECTION document. The
+        variance is the population variance and the percentiles come from
+        the sketch, clamped to the actual min and max."""
+        percentiles = dict()
+        for p in STATS_PERCENTILES:
+            value = self.sketch.quantile(p / 100.0)
+            if value is not None:
+                value = min(max(value, self.min), self.max)
+            percentiles["p%d" % p] = value
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count else None,
+            'variance': self.m2 / self.count if self.count else None,
+            'min': self.min,
+            'min_ndb_num': self.min_ndb_num,
+            'max': self.max,
+            'max_ndb_num': self.max_ndb_num,
+            'percentiles': percentiles,
+            'sketch': self.sketch.as_doc(),
+        }
+
+
+def add_nutrient_value(stats, rec):
+    """Count the value of a NUT_DATA record in stats (a NutrientStat per
+    nutrient id)"""
+    if isinstance(rec.nutrient_val, float):
+        stats[rec.nutrient_id].add(rec.nutrient_val, rec.ndb_num)
+
+
+def nutrient_stats(recs):
+    """A NutrientStat per nutrient id over NUT_DATA records"""
+    stats = collections.defaultdict(NutrientStat)
+    for rec in recs:
+        add_nutrient_value(stats, rec)
+    return stats
+
+
+class StatsSRDirectory(WrappedSRDirectory):
+    """Wraps another SRDirectory and works out nutrient_stats while the
+    import reads NUT_DATA, so the statistics cost no extra pass over the
+    file. Every read of NUT_DATA starts over and only one read to the end
+    counts (stream mode may give up on a file and read it again)."""
+
+    def __init__(self, inner):
+        super(StatsSRDirectory, self).__init__(inner)
+        self.stats = None
+
+    def records(self, filename):
+        if filename != "NUT_DATA.txt":
+            return self.inner.records(filename)
+        return self.observe(self.inner.records(filename))
+
+    def observe(self, recs):
+        stats = collections.defaultdict(NutrientStat)
+        for rec in recs:
+            add_nutrient_value(stats, rec)
+            yield rec
+        self.stats = stats
+
+    def nutrient_stats(self):
+        """The stats of the last full read of NUT_DATA, reading it now if
+        the import never did (a resumed push past the NUT_DATA phase)"""
+        if self.stats is None:
+            self.stats = nutrient_stats(self.inner.records("NUT_DATA.txt"))
+        return self.stats
+
+
+def save_nutrient_stats(mongo, stats, nutr_defs):
+    """Replace the STATS_COLLECTION documents of the collection mongo with
+    stats (from nutrient_stats), labelled with nutr_defs"""
+    coll = mongo.database[STATS_COLLECTION]
+    docs = []
+    for nutr_def in nutr_defs:
+        nutrient_id = nutr_def["nutrient_id"]
+        doc = {
+            '_id': "%s:%s" % (mongo.name, nutrient_id),
+            'collection': mongo.name,
+            'nutrient_id': nutrient_id,
+            'units': UNIT_REPLACEMENTS.get(nutr_def["units"], nutr_def["units"]),
+            'tagname': nutr_def["tagname"],
+            'descrip': nutr_def["descrip"],
+        }
+        doc.update(stats.get(nutrient_id, NutrientStat()).as_doc())
+        docs.append(doc)
+    print("Writing %d nutrient statistics to %s" % (len(docs), STATS_COLLECTION))
+    coll.delete_many({'collection': mongo.name})
+    if docs:
+        coll.insert_many(docs)
+    build_indexes(coll, STATS_INDEXES)
+
+
+# Number of documents we hand to a single insert_many call
+INSERT_CHUNK_SIZE = 1000
+
+
+def print_survey_stats(survey_stats):
+    """Pretty print the FNDDS survey flag counts"""
+    print("Survey stats:")
+    for k, v in survey_stats.items():
+        print("  %4s: %12d" % (k, v))
+    print("")
+
+
+def insert_chunked(sink, docs, chunk_size=INSERT_CHUNK_SIZE):
+    """Write the iterable docs to sink with one sink.write per chunk_size
+    docs. Returns a tuple (docs written, write calls)"""
+    total_inserts, batches = 0, 0
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            total_inserts += sink.write(chunk)
+            batches += 1
+            chunk = []
+    if chunk:
+        total_inserts += sink.write(chunk)
+        batches += 1
+    return total_inserts, batches
+
+
+# Most estimated (BSON) bytes of ops held in one ChunkedBulk chunk
+BULK_CHUNK_BYTES = 4 << 20
+
+# ChunkedBulk BSON encodes one op in this many to estimate their size: the
+# driver encodes every op again when it executes, so encoding them all
+# here would double the work
+BULK_SIZE_SAMPLE = 32
+
+# Times a failed bulk chunk is retried, and the seconds to wait before the
+# first retry (doubled for each one after)
+BULK_RETRIES = 3
+BULK_RETRY_DELAY = 0.5
+
+# The counts in bulk execute() results that ChunkedBulk adds up
+BULK_COUNTERS = ("nInserted", "nUpserted", "nMatched", "nModified", "nRemoved")
+
+
+class BulkOps(object):
+    """The ops the import modes queue: subclasses implement add(). If set,
+    on_commit is called with the number of ops committed so far after every
+    chunk (ChunkedBulk only: PartitionedBulk writers finish out of order)"""
+
+    on_commit = None
+
+    def set(self, query, fields):
+        self.add(query, "update", ({"$set": fields},))
+
+    def replace(self, query, doc, upsert=False):
+        self.add(query, "replace_one", (doc,), upsert)
+
+    def update(self, query, update):
+        self.add(query, "update", (update,), idempotent=False)
+
+    def remove(self, query):
+        self.add(query, "remove_one", ())
+
+    def abort(self):
+        """Give up on the ops not written yet (after an error while queuing)"""
+        pass
+
+
+class ChunkedBulk(BulkOps):
+    """A bulk op executed every chunk_size ops (or max_bytes of estimated op
+    size) instead of all at once, adding up the results of every chunk.
+    Failed ops are retried on their own, lost chunks only if idempotent.
+    Every execute is timed in to the "bulk_write" histogram of metrics."""
+
+    def __init__(self, mongo, chunk_size=INSERT_CHUNK_SIZE, max_bytes=BULK_CHUNK_BYTES, retries=BULK_RETRIES, ordered=False, metrics=None):
+        self.mongo = mongo
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.ordered = ordered
+        self.ops = []
+        self.op_bytes = 0
+        self.idempotent = True
+        self.results = dict((k, 0) for k in BULK_COUNTERS)
+        self.results.update(writeErrors=[], writeConcernErrors=[], chunks=0, retries=0)
+        self.committed = 0
+        self.metrics = metrics
+        self.seen = self.sampled = self.sampled_bytes = 0
+
+    def add(self, query, method, args, upsert=False, idempotent=True):
+        self.ops.append((query, method, args, upsert))
+        # The size of an op is the average of the sampled ones
+        if self.seen % BULK_SIZE_SAMPLE == 0:
+            self.sampled += 1
+            self.sampled_bytes += sum(len(bson.BSON.encode(d)) for d in (query,) + args)
+        self.seen += 1
+        self.op_bytes += self.sampled_bytes // self.sampled
+        self.idempotent = self.idempotent and idempotent
+        if len(self.ops) >= self.chunk_size or self.op_bytes >= self.max_bytes:
+            self.flush()
+
+    def execute(self, ops):
+        if self.ordered:
+            bulk = self.mongo.initialize_ordered_bulk_op()
+        else:
+            bulk = self.mongo.initialize_unordered_bulk_op()
+        for query, method, args, upsert in ops:
+            view = bulk.find(query)
+            if upsert:
+                view = view.upsert()
+            getattr(view, method)(*args)
+        start = time.perf_counter()
+        try:
+            return bulk.execute()
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("bulk_write", time.perf_counter() - start)
+
+    def retry(self, attempt, message):
+        print("%s - retry %d of %d" % (message, attempt + 1, self.retries))
+        self.results["retries"] += 1
+        time.sleep(BULK_RETRY_DELAY * (2 ** attempt))
+
+    def flush(self):
+        ops, idempotent = self.ops, self.idempotent
+        self.ops, self.op_bytes, self.idempotent = [], 0, True
+        if not ops:
+            return
+        self.results["chunks"] += 1
+        chunk_ops = len(ops)
+
+        for attempt in range(self.retries + 1):
+            try:
+                # Unacknowledged (w=0) writes don't return results
+                results, failed = self.execute(ops) or {}, []
+            except pymongo.errors.BulkWriteError as e:
+                results = e.details
+                failed = results.get("writeErrors", [])
+            except pymongo.errors.AutoReconnect as e:
+                # We can't know which of the ops were applied
+                if not idempotent or attempt >= self.retries:
+                    raise
+                self.retry(attempt, "Lost connection writing %d ops (%s)" % (len(ops), e))
+                continue
+
+            for k in BULK_COUNTERS:
+                self.results[k] += results.get(k, 0)
+            self.results["writeConcernErrors"].extend(results.get("writeConcernErrors", []))
+            if self.results["writeConcernErrors"] or (failed and attempt >= self.retries):
+                self.results["writeErrors"].extend(failed)
+                report_bulk(self.results)  # Raises BulkFailure
+            if not failed:
+                self.committed += chunk_ops
+                if self.on_commit:
+                    self.on_commit(self.committed)
+                return
+
+            # Error indexes are in to the ops we just sent. An ordered bulk
+            # stops at its first error, so everything from there is resent.
+            if self.ordered:
+                ops = ops[failed[0]["index"]:]
+            else:
+                ops = [ops[err["index"]] for err in failed]
+            self.retry(attempt, "%d ops failed" % len(ops))
+
+    def report(self):
+        """Print the results added up over every chunk, raising BulkFailure
+        if there were errors"""
+        report_bulk(self.results)
+
+
+# Where push mode keeps its checkpoints: a document per collection
+CHECKPOINT_COLLECTION = "nndb_import_checkpoints"
+
+
+def release_fingerprint(release):
+    """Identify the data files of release by name, size and mtime"""
+    digest = hashlib.sha1()
+    for filename in SR_FILES:
+        st = os.stat(release.path(filename))
+        digest.update(("%s %d %d\n" % (filename, st.st_size, st.st_mtime_ns)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Checkpoint(object):
+    """How far a push mode import in to collection has got, kept in
+    CHECKPOINT_COLLECTION: for every phase (a file name, see PUSH_PHASES)
+    that has started, the number of its records whose ops are committed and
+    whether it is done. Phases running at once save through a lock. Only a
+    checkpoint for the same release (see release_fingerprint) is used."""
+
+    def __init__(self, collection, release):
+        self.meta = collection.database[CHECKPOINT_COLLECTION]
+        self.key = collection.name
+        self.fingerprint = release_fingerprint(release)
+        self.phases = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Return {phase: (committed records, done)} or None"""
+        doc = self.meta.find_one({'_id': self.key})
+        if doc is None or doc.get("fingerprint") != self.fingerprint:
+            return None
+        if "phases" in doc:
+            phases = [(p["phase"], (p["committed"], p["done"])) for p in doc["phases"]]
+        else:
+            # Written before phases could run at once: one phase in progress
+            current = PUSH_PHASES.index(doc["phase"])
+            phases = [(phase, (0, True)) for phase in PUSH_PHASES[:current]]
+            phases.append((doc["phase"], (doc["committed"], False)))
+        with self.lock:
+            self.phases = collections.OrderedDict(phases)
+            return dict(self.phases)
+
+    def save(self, phase, committed=0, done=False):
+        with self.lock:
+            self.phases[phase] = (committed, done)
+            self.meta.replace_one({'_id': self.key}, {
+                '_id': self.key,
+                'fingerprint': self.fingerprint,
+                'phases': [
+                    {'phase': name, 'committed': count, 'done': finished}
+                    for name, (count, finished) in self.phases.items()
+                ],
+                'saved': time.time(),
+            }, upsert=True)
+
+    def start(self):
+        """Forget any earlier progress: the import starts over"""
+        with self.lock:
+            self.phases = collections.OrderedDict()
+
+    def remove(self):
+        self.meta.delete_one({'_id': self.key})
+
+
+# The phases of push mode, in order
+PUSH_PHASES = ["FOOD_DES.txt"] + [filename for filename, field, build in FOOD_ARRAYS]
+
+
+def reset_pushed(sink, release, lookups, phase, committed, chunk_size=INSERT_CHUNK_SIZE):
+    """Before push mode resumes FOOD_ARRAYS[phase] after its first committed
+    records, $set the array of every food the rest of the phase pushes to
+    back to what the committed records (and earlier phases filling the same
+    field) gave it. Anything an uncommitted chunk managed to push is
+    dropped, so nothing ends up in an array twice."""
+    filename, field, build = FOOD_ARRAYS[phase]
+    touched = set(
+        rec.ndb_num
+        for count, rec in enumerate(release.records(filename))
+        if count >= committed
+    )
+    arrays = dict((ndb_num, []) for ndb_num in touched)
+
+    for idx, (prev_fn, prev_field, prev_build) in enumerate(FOOD_ARRAYS[:phase + 1]):
+        if prev_field != field:
+            continue
+        for count, rec in enumerate(release.records(prev_fn)):
+            if idx == phase and count >= committed:
+                break
+            if rec.ndb_num in arrays:
+                arrays[rec.ndb_num].append(prev_build(rec, lookups))
+
+    print("Resetting %s on %d foods" % (field, len(arrays)))
+    bulk = sink.bulk(chunk_size)
+    for ndb_num in sorted(arrays):
+        bulk.set({'_id': ndb_num}, {field: arrays[ndb_num]})
+    bulk.flush()
+    bulk.report()
+
+
+def push_phase_graph():
+    """The phases of push mode as (phase, phases it waits for): FOOD_DES
+    first, then each of FOOD_ARRAYS once FOOD_DES and the earlier phases
+    pushing on to the same field are done (so footnotes keep their order)"""
+    graph = [("FOOD_DES.txt", [])]
+    for idx, (filename, field, build) in enumerate(FOOD_ARRAYS):
+        deps = ["FOOD_DES.txt"] + [
+            prev_fn for prev_fn, prev_field, prev_build in FOOD_ARRAYS[:idx] if prev_field == field
+        ]
+        graph.append((filename, deps))
+    return graph
+
+
+def run_phases(phases, workers=1, metrics=None):
+    """Run phases, a list of (name, names it waits for, function), on up to
+    workers threads, each as soon as everything it waits for is done. A
+    failure stops anything new from starting and is raised once the phases
+    already running finish. Prints and returns [(name, seconds)]. Each
+    phase is also added to metrics (if given) as push:<name>, with the CPU
+    time of its own thread."""
+    def timed(name, run):
+        start, cpu = time.perf_counter(), time.thread_time()
+        run()
+        elapsed = time.perf_counter() - start
+        if metrics is not None:
+            metrics.add_phase("push:" + name, elapsed, time.thread_time() - cpu)
+        return elapsed
+
+    workers = max(workers, 1)
+    wall_start = time.perf_counter()
+    pending, running, done, timings, failure = list(phases), {}, set(), [], None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for phase in list(pending):
+                name, deps, run = phase
+                if failure is None and len(running) < workers and all(dep in done for dep in deps):
+                    pending.remove(phase)
+                    running[pool.submit(timed, name, run)] = name
+            if not running:
+                if failure is None:
+                    raise ValueError("Phases %s wait for phases that never run" % [p[0] for p in pending])
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings.append((name, future.result()))
+                    done.add(name)
+                except BaseException as exc:
+                    failure = failure or exc
+    if failure is not None:
+        raise failure
+
+    print("Phase timings (%d at once):" % workers)
+    for name, elapsed in timings:
+        print("  %-20s %8.3fs" % (name, elapsed))
+    print("...%.3fs for %.3fs of phases" % (time.perf_counter() - wall_start, sum(t for _, t in timings)))
+    return timings
+
+
+def push_import(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE, resume=False, progress=None):
+    """Insert bare FOOD_DES documents and then $push every row of the other
+    principal files on to them (one update op per row). Needs a MongoSink.
+    Up to sink.phases phases run at once, as push_phase_graph allows.
+    A Checkpoint is saved as each phase goes; resume carries on from it.
+    progress (see process_directory) hears of every phase and record."""
+    mongo = sink.collection
+    checkpoint = Checkpoint(mongo, release)
+
+    state = checkpoint.load() if resume else None
+    if resume and state is None:
+        print("No checkpoint for this release - starting over")
+        sink.clear()
+    if state is not None and not state.get("FOOD_DES.txt", (0, False))[1]:
+        # Inserting the foods is cheap: just do it again
+        print("Resuming before the foods were inserted - starting over")
+        sink.clear()
+        state = None
+    if state is None:
+        checkpoint.start()
+    else:
+        print("Resuming from the checkpoint of %s" % ", ".join(
+            "%s (%d records%s)" % (name, committed, ", done" if done else "")
+            for name, (committed, done) in sorted(state.items(), key=lambda item: PUSH_PHASES.index(item[0]))
+        ))
+
+    totals = {'inserts': mongo.count() if state else 0}
+    # Every phase splits the foods between the writers the same way
+    bounds = sink.partition(release)
+
+    def foods():
+        if state:
+            print("Already inserted foods")
+            return
+        checkpoint.save("FOOD_DES.txt")
+        totals['inserts'] = insert_foods(sink, release, lookups, chunk_size)
+        checkpoint.save("FOOD_DES.txt", totals['inserts'], done=True)
+
+    runs = dict(
+        (filename, functools.partial(
+            push_phase, sink, release, lookups, checkpoint, phase, (state or {}).get(filename), chunk_size, bounds,
+            progress
+        ))
+        for phase, (filename, field, build) in enumerate(FOOD_ARRAYS)
+    )
+    runs["FOOD_DES.txt"] = foods
+    run_phases(
+        [(name, deps, runs[name]) for name, deps in push_phase_graph()],
+        getattr(sink, "phases", 1), getattr(sink, "metrics", None)
+    )
+
+    checkpoint.remove()
+    return totals['inserts']
+
+
+def push_phase(
+    sink, release, lookups, checkpoint, phase, start=None, chunk_size=INSERT_CHUNK_SIZE, bounds=None, progress=None
+):
+    """$push every record of FOOD_ARRAYS[phase] on to its food. start is the
+    phase's (committed records, done) from the checkpoint being resumed, or
+    None if it never started. bounds is sink.partition(release)."""
+    filename, field, build = FOOD_ARRAYS[phase]
+    if start is not None and start[1]:
+        print("Already loaded %s into %s" % (filename, field))
+        return
+
+    skip = 0
+    if start is not None:
+        skip = start[0]
+        reset_pushed(sink, release, lookups, phase, skip, chunk_size)
+    checkpoint.save(filename, skip)
+
+    print("Loading %s into %s..." % (filename, field))
+    if progress:
+        progress(filename)
+    reported = [0]
+
+    def report(committed):
+        if progress and committed > reported[0]:
+            progress(None, records=committed - reported[0])
+            reported[0] = committed
+
+    def on_commit(committed):
+        checkpoint.save(filename, skip + committed)
+        report(committed)
+
+    bulk = sink.bulk(chunk_size, bounds=bounds)
+    bulk.on_commit = on_commit
+    count = 0
+    try:
+        for rec in release.records(filename):
+            count += 1
+            if count <= skip:
+                continue
+            bulk.update({'_id': rec.ndb_num}, {"$push": {field: build(rec, lookups)}})
+            if count % 50000 == 0:
+                print("  %s: %7d" % (field, count))
+        bulk.flush()
+    except BaseException:
+        bulk.abort()
+        raise
+    report(count - skip)  # A PartitionedBulk only reports when it's done
+    print("...Total %s rows read: %d" % (filename, count))
+
+    if count > skip:
+        print("Bulk updated %s" % field)
+        bulk.report()
+    checkpoint.save(filename, count, done=True)
+
+
+def insert_foods(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """The first phase of push mode: insert the bare FOOD_DES documents"""
     # First create all the entries with default values from the main file
-    # Note that we use upsert - one of main goals is to be restartable and
-    # re-runnable.
     print("Creating entries...")
     count = 0
 
     survey_stats = collections.defaultdict(int, [("", 0), ("Y", 0)])
     entries = []
 
-    for entry in food_des_recs(get_fn("FOOD_DES.txt")):
-        # Just in case we ever decide to use something else for _id
-        entry_id = entry['_id']
-        entry['ndb_num'] = entry_id
-
-        # Handle numeric fields
-        nums(entry, ["n_factor", "protein_factor", "fat_factor", "carb_factor"])
-
-        # Setup defaults
-        entry.update({
-            'nutrients': list(),
-            'food_group_descrip': food_grp_codes[entry["food_group_code"]],
-            'footnotes': list(),
-            'langual_entries': list(),
-            'measures': list(),
-        })
-
-        # Upsert our entry
-        entries.append(entry)
+    for rec in release.records("FOOD_DES.txt"):
+        entries.append(food_entry(rec, lookups))
 
         count += 1
-        survey_stats[entry['survey']] += 1
+        survey_stats[rec.survey] += 1
         if count % 3000 == 0:
             print("  Created %7d" % count)
 
     # Perform bulk operation
     print("Sending bulked inserts")
-    total_inserts = len(mongo.insert_many(entries, False).inserted_ids)
+    total_inserts, _ = insert_chunked(sink, entries, chunk_size)
     entries = []   # Clean up
 
     print("...Total Records Seen: %d" % count)
     print("...Total Inserts Seen: %d" % total_inserts)
-    print("Survey stats:")
-    for k, v in survey_stats.items():
-        print("  %4s: %12d" % (k, v))
-    print("")
+    print_survey_stats(survey_stats)
 
     if count != total_inserts:
         raise BulkFailure("Could not insert initial records")
 
-    print("Loading weights/measures")
-    weight_recs = nndb_recs(get_fn("WEIGHT.txt"), [
-        "ndb_num",
-        "seq",
-        "amount",
-        "descrip",
-        "gram_weight",
-        "num_data_points",
-        "stddev"
-    ])
-
-    bulk = mongo.initialize_unordered_bulk_op()
-    count = 0
-    for entry in weight_recs:
-        bulk.find({'_id': entry["ndb_num"]}).update({"$push": {"measures": entry}})
-        count += 1
-        if count % 10000 == 0:
-            print("  weights: %7d" % count)
-    print("...Total weights read: %d" % count)
+    return total_inserts
+
+
+def join_foods(release):
+    """Join every principal file in memory by NDB_No. Returns an OrderedDict
+    (in FOOD_DES order) of NDB_No => (FOOD_DES record, child records) where
+    the children are a list of records for each of FOOD_ARRAYS"""
+    print("Joining entries...")
+    foods = collections.OrderedDict()
+    for rec in release.records("FOOD_DES.txt"):
+        foods[rec.id] = (rec, [list() for _ in FOOD_ARRAYS])
+    print("...Total Records Seen: %d" % len(foods))
+
+    for idx, (filename, field, build) in enumerate(FOOD_ARRAYS):
+        print("Joining %s into %s..." % (filename, field))
+        count, orphans = 0, 0
+        for rec in release.records(filename):
+            count += 1
+            food = foods.get(rec.ndb_num)
+            if food is None:
+                orphans += 1  # Would have matched nothing in push mode
+                continue
+            food[1][idx].append(rec)
+        print("...Total %s rows read: %d (%d orphans)" % (filename, count, orphans))
+
+    return foods
+
+
+def assemble_foods(release, lookups):
+    """Join every principal file in memory by NDB_No and generate the
+    complete food documents in FOOD_DES order"""
+    for food_rec, children in join_foods(release).values():
+        yield food_document(food_rec, children, lookups)
+
+
+def grouped_by_ndb(filename, recs, key_of=operator.attrgetter("ndb_num")):
+    """Yield (ndb_num, [records]) for each run of records sharing a key.
+    Raises SortOrderError if the keys in the file ever go backwards."""
+    prev, group = None, []
+    for count, rec in enumerate(recs, 1):
+        key = key_of(rec)
+        if key != prev:
+            if prev is not None:
+                if key < prev:
+                    raise SortOrderError("%s is not sorted by NDB_No (%s after %s at record %d)" % (
+                        os.path.basename(filename), key, prev, count
+                    ))
+                yield prev, group
+            prev, group = key, []
+        group.append(rec)
+    if prev is not None:
+        yield prev, group
+
+
+class SortedGroups(object):
+    """One side of a merge-join: the records of a file sorted by NDB_No,
+    handed out a key at a time. take() must be called with ascending keys."""
+
+    def __init__(self, filename, recs):
+        self.filename = filename
+        self.groups = grouped_by_ndb(filename, recs)
+        self.head = next(self.groups, None)
+        self.count = 0
+        self.orphans = 0
+
+    def take(self, ndb_num):
+        """Return the records for ndb_num, skipping (and counting) any
+        records for keys before it"""
+        while self.head is not None and self.head[0] < ndb_num:
+            self.orphans += len(self.head[1])
+            self.advance()
+        if self.head is not None and self.head[0] == ndb_num:
+            found = self.head[1]
+            self.advance()
+            return found
+        return []
+
+    def advance(self):
+        self.count += len(self.head[1])
+        self.head = next(self.groups, None)
+
+    def finish(self):
+        """Everything left once the foods run out matches nothing"""
+        while self.head is not None:
+            self.orphans += len(self.head[1])
+            self.advance()
+
+
+def merge_join_foods(release, lookups):
+    """Generator of complete food documents built with a k-way merge-join of
+    FOOD_DES against the other principal files. Every file must be sorted by
+    NDB_No (SortOrderError otherwise); only one food is held at a time."""
+    streams = [
+        SortedGroups(filename, release.records(filename))
+        for filename, field, build in FOOD_ARRAYS
+    ]
+
+    prev = None
+    for rec in release.records("FOOD_DES.txt"):
+        if prev is not None and rec.id <= prev:
+            raise SortOrderError("FOOD_DES.txt is not sorted by NDB_No (%s after %s)" % (rec.id, prev))
+        prev = rec.id
+
+        yield food_document(rec, [stream.take(rec.id) for stream in streams], lookups)
+
+    for stream in streams:
+        stream.finish()
+        print("...Total %s rows read: %d (%d orphans)" % (stream.filename, stream.count, stream.orphans))
+
+
+def assemble_import(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """Join every file in memory and insert each food document exactly once"""
+    foods = join_foods(release)
 
-    print("Bulk updating weights")
-    report_bulk(bulk.execute())
+    survey_stats = collections.defaultdict(int, [("", 0), ("Y", 0)])
+    for food_rec, children in foods.values():
+        survey_stats[food_rec.survey] += 1
 
-    print("Loading LanguaL Codes...")
-    bulk = mongo.initialize_unordered_bulk_op()
-    count = 0
-    for entry in nndb_recs(get_fn("LANGUAL.txt"), ["ndb_num", "code"]):
-        lang = langual_codes[entry["code"]]
-        bulk.find({'_id': entry["ndb_num"]}).update({"$push": {"langual_entries": lang}})
-        count += 1
-        if count % 10000 == 0:
-            print("  LanguaL items: %7d" % count)
-    print("...Total codes read: %d" % count)
+    print("Sending chunked inserts")
+    total_inserts, batches = insert_chunked(sink, (
+        food_document(food_rec, children, lookups)
+        for food_rec, children in foods.values()
+    ), chunk_size)
 
-    print("Bulk updating LanguaL codes")
-    report_bulk(bulk.execute())
+    print("...Total Inserts Seen: %d (%d writes)" % (total_inserts, batches))
+    print_survey_stats(survey_stats)
 
-    print("Reading source code descrips")
-    src_codes = recs_to_lookup(get_fn("SRC_CD.txt"))
+    if len(foods) != total_inserts:
+        raise BulkFailure("Could not insert assembled records")
 
-    print("Reading data derivation code descrips")
-    deriv_codes = recs_to_lookup(get_fn("DERIV_CD.txt"))
+    return total_inserts
 
-    print("Reading data sources for footnotes")
-    data_srcs = recs_to_dict("datasrc_id", nndb_recs(get_fn("DATA_SRC.txt"), [
-        "datasrc_id",
-        "authors",
-        "title",
-        "year",
-        "journal",
-        "vol_city",
-        "issue_state",
-        "start_page",
-        "end_page",
-    ]))
-
-    print("Adding footnotes to food items...")
-    footnote_recs = nndb_recs(get_fn("FOOTNOTE.txt"), [
-        "ndb_num",
-        "footnote_num",
-        "footnote_type",
-        "nutr_num",
-        "text"
-    ])
-    bulk = mongo.initialize_unordered_bulk_op()
-    count = 0
-    for entry in footnote_recs:
-        entry["type"] = "footnote"
-        bulk.find({'_id': entry["ndb_num"]}).update({"$push": {"footnotes": entry}})
-        count += 1
-        if count % 50000 == 0:
-            print("  footnotes: %7d" % count)
-    print("...Total foot notes: %7d" % count)
 
-    print("Adding data sources to food items as footnotes...")
-    count = 0
-    for entry in nndb_recs(get_fn("DATSRCLN.txt"), ["ndb_num", "nutr_num", "datasrc_id"]):
-        entry.update(data_srcs[entry["datasrc_id"]])
-        entry["type"] = "data-source"
-        bulk.find({'_id': entry["ndb_num"]}).update({"$push": {"footnotes": entry}})
-        count += 1
-        if count % 50000 == 0:
-            print("  data sources: %7d" % count)
-    print("...Total data sources: %7d" % count)
+def stream_import(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """Merge-join the sorted files and insert each food as it is finished,
+    so at most chunk_size documents are in memory. Falls back to assemble
+    mode if a file turns out not to be sorted."""
+    survey_stats = collections.defaultdict(int, [("", 0), ("Y", 0)])
 
-    print("Bulk updating footnotes")
-    report_bulk(bulk.execute())
+    def counted(entries):
+        for entry in entries:
+            survey_stats[entry['survey']] += 1
+            yield entry
 
-    print("Reading nutrient defs...")
-    nutr_defs = recs_to_dict(
-        "nutrient_id",
-        nutr_def_recs(get_fn("NUTR_DEF.txt"))
-    )
+    print("Streaming entries...")
+    try:
+        total_inserts, batches = insert_chunked(
+            sink,
+            counted(merge_join_foods(release, lookups)),
+            chunk_size
+        )
+    except SortOrderError as e:
+        print("%s - falling back to in-memory assembly" % e)
+        sink.clear()
+        return assemble_import(sink, release, lookups, chunk_size)
+
+    count = sum(survey_stats.values())
+    print("...Total Records Seen: %d" % count)
+    print("...Total Inserts Seen: %d (%d writes)" % (total_inserts, batches))
+    print_survey_stats(survey_stats)
 
-    print("Loading nutrition items...")
-    bulk = mongo.initialize_unordered_bulk_op()
-    count = 0
-    for entry in nut_data_recs(get_fn("NUT_DATA.txt")):
-        nums(entry, [
-            "nutrient_val",
-            "data_point_count",
-            "std_error",
-            "num_studies",
-            "min_value", "max_value",
-            "degrees_freedom",
-            "lower_err_bound", "upper_err_bound",
-        ])
+    if count != total_inserts:
+        raise BulkFailure("Could not insert streamed records")
 
-        # Add descriptions for the codes we know
-        entry["source_descrip"] = src_codes[entry["source_code"]]
-        entry["derivation_descrip"] = deriv_codes[entry["derivation_code"]]
+    return total_inserts
 
-        # Just add the nutrient def info to the entry
-        xtra = nutr_defs[entry["nutrient_id"]]
-        entry.update(xtra)
 
-        # Ensure units are the way we want them
-        entry["units"] = UNIT_REPLACEMENTS.get(entry["units"], entry["units"])
+# The field incremental mode keeps each food's content hash in
+HASH_FIELD = "content_hash"
 
-        bulk.find({'_id': entry["ndb_num"]}).update({"$push": {"nutrients": entry}})
-        count += 1
-        if count % 50000 == 0:
-            print("  nutrient items: %7d" % count)
-    print("...Total nutrient items: %7d" % count)
+# Max NDB numbers listed per category in the incremental summary
+DIFF_LIST_MAX = 100
+
+
+def json_binary(value):
+    """json.dumps default for binary fields (like nutrient vectors)"""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def food_hash(doc):
+    """SHA-1 of the canonical JSON form of a food document"""
+    canon = json.dumps(doc, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=json_binary)
+    return hashlib.sha1(canon.encode("utf-8")).hexdigest()
+
+
+def diff_foods(bulk, docs, existing, written):
+    """Hash every doc and queue an upsert for the ones that are new or
+    differ from the existing (NDB_No => hash) map, along with any written
+    earlier in this run. Returns (added, changed, unchanged count, seen)"""
+    added, changed, unchanged = [], [], 0
+    seen = set()
+    for doc in docs:
+        ndb_num = doc['_id']
+        doc[HASH_FIELD] = food_hash(doc)
+        seen.add(ndb_num)
+
+        if ndb_num not in existing:
+            added.append(ndb_num)
+        elif existing[ndb_num] != doc[HASH_FIELD]:
+            changed.append(ndb_num)
+        elif ndb_num not in written:
+            unchanged += 1
+            continue
+
+        bulk.replace({'_id': ndb_num}, doc, upsert=True)
+        written.add(ndb_num)
+
+    return added, changed, unchanged, seen
+
+
+def print_ndb_list(label, ndb_nums):
+    """Print a (capped) list of NDB numbers for the diff summary"""
+    print("%s: %d" % (label, len(ndb_nums)))
+    shown = sorted(ndb_nums)[:DIFF_LIST_MAX]
+    for i in range(0, len(shown), 10):
+        print("  " + " ".join(shown[i:i + 10]))
+    if len(ndb_nums) > len(shown):
+        print("  ... and %d more" % (len(ndb_nums) - len(shown)))
 
-    print("Bulk updating nutrient items")
+
+def incremental_import(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """Compare a content hash of every assembled food with the hash stored
+    on the existing document, and only write the foods that were added or
+    changed and delete the ones that are gone. Nothing is cleared first.
+    Needs a MongoSink."""
+    mongo = sink.collection
+
+    print("Reading content hashes of existing foods")
+    existing = dict(
+        (doc['_id'], doc.get(HASH_FIELD))
+        for doc in mongo.find({}, {HASH_FIELD: True})
+    )
+    print("...Existing foods: %d" % len(existing))
+
+    bulk = sink.bulk(chunk_size, release)
+    written = set()
+
+    print("Diffing entries...")
+    try:
+        try:
+            added, changed, unchanged, seen = diff_foods(
+                bulk, merge_join_foods(release, lookups), existing, written
+            )
+        except SortOrderError as e:
+            # Foods already written may have been incomplete: written makes
+            # sure the second pass rewrites them
+            print("%s - falling back to in-memory assembly" % e)
+            added, changed, unchanged, seen = diff_foods(
+                bulk, assemble_foods(release, lookups), existing, written
+            )
+
+        removed = sorted(set(existing) - seen)
+        for ndb_num in removed:
+            bulk.remove({'_id': ndb_num})
+        bulk.flush()
+    except BaseException:
+        bulk.abort()
+        raise
+    bulk.report()
+
+    print_ndb_list("Added", added)
+    print_ndb_list("Changed", changed)
+    print_ndb_list("Removed", removed)
+    print("Unchanged: %d" % unchanged)
+
+    return len(seen)
+
+
+# The collections normalized mode keeps under the target collection (which
+# holds the lean foods), e.g. nndb.nutrient_values
+NORMALIZED_COLLECTIONS = ("nutrient_defs", "data_sources", "codes", "nutrient_values")
+
+# Indexes for nutrient_values: the nutrients of a food, and the foods
+# richest in a nutrient
+NUTRIENT_VALUE_INDEXES = [
+    ("food_nutrient", [("ndb_num", pymongo.ASCENDING), ("nutrient_id", pymongo.ASCENDING)]),
+    ("nutrient_value", [("nutrient_id", pymongo.ASCENDING), ("nutrient_val", pymongo.DESCENDING)]),
+]
+
+
+def lean_food(food):
+    """Split a complete food document in to its normalized form. Returns
+    (lean food, nutrient values): the nutrients become nutrient_values
+    documents without the NUTR_DEF and code descriptions, and data source
+    footnotes keep only their DATSRCLN reference."""
+    values = [
+        dict((k, entry[k]) for k in NutData.doc_fields)
+        for entry in food.pop("nutrients")
+    ]
+    food["footnotes"] = [
+        dict((k, note[k]) for k in DatSrcLn.doc_fields + ("type",))
+        if note["type"] == "data-source" else note
+        for note in food["footnotes"]
+    ]
+    return food, values
+
+
+def write_normalized_lookups(mongo, lookups):
+    """Fill the small collections of normalized mode from lookups"""
+    print("Writing nutrient_defs, data_sources and codes")
+    nutr_defs = []
+    for nutrient_id, nutr_def in sorted(lookups.nutr_defs.items()):
+        doc = dict(nutr_def, _id=nutrient_id)
+        doc["units"] = UNIT_REPLACEMENTS.get(doc["units"], doc["units"])
+        nutr_defs.append(doc)
+    data_srcs = [dict(src, _id=datasrc_id) for datasrc_id, src in sorted(lookups.data_srcs.items())]
+    codes = [
+        {'_id': "%s:%s" % (code_type, code), 'type': code_type, 'code': code, 'descrip': descrip}
+        for code_type, descrips in (("source", lookups.src_codes), ("derivation", lookups.deriv_codes))
+        for code, descrip in sorted(descrips.items())
+        if code
+    ]
+    for name, docs in (("nutrient_defs", nutr_defs), ("data_sources", data_srcs), ("codes", codes)):
+        if docs:
+            mongo[name].insert_many(docs)
+
+
+def normalized_import(sink, release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """Write lean food documents (see lean_food) to the target collection
+    and the nutrient values, nutrient definitions, data sources and code
+    descriptions to NORMALIZED_COLLECTIONS under it. NormalizedLookups puts
+    the full documents back together. Needs a MongoSink."""
+    mongo = sink.collection
+    for name in NORMALIZED_COLLECTIONS:
+        mongo[name].drop()
+    write_normalized_lookups(mongo, lookups)
+
+    values = MongoSink(mongo.nutrient_values, indexes=False, ordered=sink.ordered, metrics=sink.metrics)
+    value_count = [0]
+
+    def split(docs):
+        batch = []
+        for doc in docs:
+            food, food_values = lean_food(doc)
+            batch.extend(food_values)
+            if len(batch) >= chunk_size:
+                value_count[0] += values.write(batch)
+                batch = []
+            yield food
+        if batch:
+            value_count[0] += values.write(batch)
+
+    print("Streaming lean entries...")
+    try:
+        total_inserts, batches = insert_chunked(sink, split(merge_join_foods(release, lookups)), chunk_size)
+    except SortOrderError as e:
+        print("%s - falling back to in-memory assembly" % e)
+        sink.clear()
+        values.clear()
+        value_count[0] = 0
+        total_inserts, batches = insert_chunked(sink, split(assemble_foods(release, lookups)), chunk_size)
+
+    print("...Total Inserts Seen: %d (%d writes)" % (total_inserts, batches))
+    print("...Total nutrient values: %d" % value_count[0])
+    build_indexes(values.collection, NUTRIENT_VALUE_INDEXES)
+    return total_inserts
+
+
+class NormalizedLookups(object):
+    """Client side cache of the small normalized mode collections under
+    collection. Each is read once, on first use, and kept in memory: there
+    are only a few hundred nutrient definitions and data sources."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.tables = {}
+
+    def table(self, name):
+        """_id => document (without _id) for a whole collection"""
+        if name not in self.tables:
+            self.tables[name] = dict(
+                (doc.pop('_id'), doc) for doc in self.collection[name].find()
+            )
+        return self.tables[name]
+
+    def code_descrip(self, code_type, code):
+        return self.table("codes").get("%s:%s" % (code_type, code), {}).get("descrip", "")
+
+    def nutrient_entry(self, value):
+        """The full nutrients entry for a nutrient_values document"""
+        entry = dict((k, value[k]) for k in NutData.doc_fields)
+        entry["source_descrip"] = self.code_descrip("source", entry["source_code"])
+        entry["derivation_descrip"] = self.code_descrip("derivation", entry["derivation_code"])
+        entry.update(self.table("nutrient_defs")[entry["nutrient_id"]])
+        return entry
+
+    def footnote_entry(self, note):
+        """Data source footnotes get their DATA_SRC citation back"""
+        if note["type"] != "data-source":
+            return note
+        entry = dict(note)
+        entry.update(self.table("data_sources")[note["datasrc_id"]])
+        return entry
+
+    def food(self, food):
+        """The full document, as the other modes write it, for a lean food"""
+        food = dict(food)
+        food["footnotes"] = [self.footnote_entry(note) for note in food["footnotes"]]
+        values = self.collection.nutrient_values.find({'ndb_num': food['_id']}).sort('_id')
+        food["nutrients"] = [self.nutrient_entry(value) for value in values]
+        return food
+
+
+# Supported import modes for process_directory
+IMPORT_MODES = {
+    "push": push_import,
+    "assemble": assemble_import,
+    "stream": stream_import,
+    "incremental": incremental_import,
+    "normalized": normalized_import,
+}
+
+# The modes that only hand finished documents to Sink.write, so they work
+# with any sink. The others need a MongoSink.
+DOCUMENT_MODES = ("assemble", "stream")
+
+
+def clear_collection(mongo):
+    """Remove every document from the collection"""
+    print("Clearing database")
+    bulk = mongo.initialize_ordered_bulk_op()
+    bulk.find({}).remove()
     report_bulk(bulk.execute())
 
 
+# Indexes for the queries in optimize/food_query.js and lookups by nutrient,
+# as (index name, keys). They are built after the bulk load: maintaining them
+# while inserting is much slower than one build over the finished collection.
+INDEX_PLAN = [
+    ("survey_food_group", [("survey", pymongo.ASCENDING), ("food_group_code", pymongo.ASCENDING)]),
+    ("nutrient_id", [("nutrients.nutrient_id", pymongo.ASCENDING)]),
+    ("langual_code", [("langual_entries.code", pymongo.ASCENDING)]),
+    ("descrip_text", [("descrip", pymongo.TEXT), ("short_descrip", pymongo.TEXT), ("common_name", pymongo.TEXT)]),
+]
+
+
+def drop_indexes(mongo, plan=INDEX_PLAN):
+    """Drop the indexes in plan so the load doesn't maintain them. Any
+    other index on the collection isn't ours and is left alone."""
+    print("Dropping indexes")
+    existing = mongo.index_information()
+    for name, keys in plan:
+        if name in existing:
+            mongo.drop_index(name)
+
+
+def build_indexes(mongo, plan=INDEX_PLAN):
+    """Build every index in plan, printing the time each one took. Returns
+    a list of (index name, seconds)"""
+    print("Building indexes...")
+    timings = []
+    for name, keys in plan:
+        start = time.perf_counter()
+        mongo.create_index(keys, name=name)
+        elapsed = time.perf_counter() - start
+        print("  %-20s %8.3fs" % (name, elapsed))
+        timings.append((name, elapsed))
+    print("...Built %d indexes in %.3fs" % (len(timings), sum(t for _, t in timings)))
+    return timings
+
+
+class Sink(object):
+    """Where an import writes its food documents. clear() starts an empty
+    output, write() takes a list of documents and returns the number
+    written, and close() (or abort() on failure) finishes the output.
+    Only a threadsafe sink may be written by more than one thread."""
+
+    threadsafe = False
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def write(self, docs):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class MongoSink(Sink):
+    """Writes to a MongoDB collection with insert_many, and hands out
+    ChunkedBulk ops of chunk_bytes (or a PartitionedBulk over writers).
+    With indexes, clear() drops the INDEX_PLAN and close() builds it again.
+    All writes use write_concern (the collection's if None) and ordered.
+    Push mode runs up to phases of its phases at once (see push_import).
+    Bulk writes and index builds are reported to metrics if given."""
+
+    threadsafe = True
+
+    def __init__(self, collection, indexes=True, chunk_bytes=BULK_CHUNK_BYTES, writers=1, write_concern=None, ordered=False, phases=1, metrics=None):
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+        self.collection = collection
+        self.indexes = indexes
+        self.chunk_bytes = chunk_bytes
+        self.writers = writers
+        self.write_concern = write_concern
+        self.ordered = ordered
+        self.phases = phases
+        self.metrics = metrics
+
+    def for_collection(self, collection):
+        """A MongoSink with the same settings for another collection"""
+        return MongoSink(
+            collection, self.indexes, self.chunk_bytes, self.writers, self.write_concern, self.ordered,
+            self.phases, self.metrics
+        )
+
+    def chunked_bulk(self, chunk_size=INSERT_CHUNK_SIZE):
+        return ChunkedBulk(self.collection, chunk_size, self.chunk_bytes, ordered=self.ordered, metrics=self.metrics)
+
+    def partition(self, release):
+        """The NDB_No bounds (see ndb_ranges) splitting the foods of release
+        between the writers, or None with only one writer"""
+        if self.writers < 2:
+            return None
+        return ndb_ranges([rec.id for rec in release.records("FOOD_DES.txt")], self.writers)
+
+    def bulk(self, chunk_size=INSERT_CHUNK_SIZE, release=None, bounds=None):
+        """A ChunkedBulk, or with more than one writer a PartitionedBulk
+        splitting the foods between them at bounds (from partition(),
+        worked out from release if not given)"""
+        if bounds is None and release is not None:
+            bounds = self.partition(release)
+        if bounds is None:
+            return self.chunked_bulk(chunk_size)
+        return PartitionedBulk(self, chunk_size, bounds)
+
+    def clear(self):
+        clear_collection(self.collection)
+        if self.indexes:
+            drop_indexes(self.collection)
+
+    def write(self, docs):
+        return len(self.collection.insert_many(docs, self.ordered).inserted_ids)
+
+    def close(self):
+        if self.indexes:
+            timings = build_indexes(self.collection)
+            if self.metrics is not None:
+                for name, elapsed in timings:
+                    self.metrics.add_phase("index:" + name, elapsed)
+
+
+class FileSink(Sink):
+    """Base for the sinks that write files: everything goes to temporary
+    files next to the real ones, which are only renamed in to place by
+    close(), so a failed import never leaves a partial file behind"""
+
+    def __init__(self, path):
+        self.path = path
+        self.outputs = []
+
+    def output(self, path):
+        """Return the temp name to write path to, removing any old one"""
+        tmp_fn = path + ".%d.tmp" % os.getpid()
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        self.outputs.append((tmp_fn, path))
+        return tmp_fn
+
+    def clear(self):
+        self.abort()
+        self.open_files()
+
+    def close(self):
+        self.close_files()
+        for tmp_fn, path in self.outputs:
+            os.replace(tmp_fn, path)
+            print("Wrote %s" % path)
+        self.outputs = []
+
+    def abort(self):
+        self.close_files()
+        for tmp_fn, path in self.outputs:
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+        self.outputs = []
+
+    def open_files(self):
+        raise NotImplementedError()
+
+    def close_files(self):
+        raise NotImplementedError()
+
+
+class NDJSONSink(FileSink):
+    """One food document per line of JSON in a gzip file"""
+
+    def __init__(self, path):
+        super(NDJSONSink, self).__init__(path)
+        self.out = None
+
+    def open_files(self):
+        self.out = gzip.open(self.output(self.path), "wt", encoding="utf-8")
+
+    def write(self, docs):
+        self.out.write("".join(json.dumps(doc, ensure_ascii=False) + "\n" for doc in docs))
+        return len(docs)
+
+    def close_files(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+
+def schema_fields(record_cls, skip=()):
+    """The schema of record_cls less the fields named in skip"""
+    return [fld for fld in record_cls.schema if fld.name not in skip]
+
+
+NDB_NUM_FIELD = Field("ndb_num", TEXT, False)
+
+# The flat tables the SQLite and Parquet sinks write: the food itself and
+# one table per array of the food document (keyed by ndb_num), with the
+# columns each builder produces taken from the record schemas
+FLAT_TABLES = collections.OrderedDict([
+    ("foods", [NDB_NUM_FIELD] + schema_fields(FoodDes, ["_id"]) + [
+        Field("food_group_descrip", TEXT, False),
+    ]),
+    ("measures", schema_fields(Weight)),
+    ("langual_entries", [NDB_NUM_FIELD] + schema_fields(LangDesc)),
+    ("footnotes", schema_fields(Footnote) + schema_fields(DatSrcLn, ["ndb_num", "nutr_num"]) + schema_fields(DataSrc, ["datasrc_id"]) + [
+        Field("type", TEXT, False),  # footnote or data-source
+    ]),
+    ("nutrients", schema_fields(NutData) + [
+        Field("source_descrip", TEXT, True),
+        Field("derivation_descrip", TEXT, True),
+    ] + schema_fields(NutrDef, ["nutrient_id"])),
+])
+
+
+def flat_value(value, fld):
+    """Empty numbers (and fields a row doesn't have) are stored as NULL"""
+    if value is None or (fld.type == FLOAT and value == ""):
+        return None
+    return value
+
+
+def flat_rows(docs):
+    """Split a list of food documents in to rows for FLAT_TABLES. Returns
+    a dict of table name => list of row tuples"""
+    rows = dict((table, []) for table in FLAT_TABLES)
+    food_fields = FLAT_TABLES["foods"]
+    for doc in docs:
+        rows["foods"].append(tuple(flat_value(doc.get(fld.name), fld) for fld in food_fields))
+        for table, fields in FLAT_TABLES.items():
+            if table == "foods":
+                continue
+            for entry in doc.get(table, ()):
+                entry = dict(entry, ndb_num=doc["_id"])
+                rows[table].append(tuple(flat_value(entry.get(fld.name), fld) for fld in fields))
+    return rows
+
+
+class SQLiteSink(FileSink):
+    """FLAT_TABLES in a SQLite database, one executemany per table and a
+    transaction per chunk. The ndb_num indexes are built by close()."""
+
+    SQL_TYPES = {TEXT: "TEXT", FLOAT: "REAL"}
+
+    def __init__(self, path):
+        super(SQLiteSink, self).__init__(path)
+        self.conn = None
+
+    def open_files(self):
+        self.conn = sqlite3.connect(self.output(self.path), check_same_thread=False)
+        for table, fields in FLAT_TABLES.items():
+            self.conn.execute("CREATE TABLE %s (%s)" % (table, ", ".join(
+                "%s %s" % (fld.name, self.SQL_TYPES[fld.type]) for fld in fields
+            )))
+
+    def write(self, docs):
+        with self.conn:
+            for table, rows in flat_rows(docs).items():
+                if rows:
+                    self.conn.executemany("INSERT INTO %s VALUES (%s)" % (
+                        table, ", ".join("?" * len(FLAT_TABLES[table]))
+                    ), rows)
+        return len(docs)
+
+    def close(self):
+        if self.conn is not None:
+            print("Indexing ndb_num")
+            with self.conn:
+                for table in FLAT_TABLES:
+                    self.conn.execute("CREATE INDEX %s_ndb_num ON %s (ndb_num)" % (table, table))
+        super(SQLiteSink, self).close()
+
+    def close_files(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class ParquetSink(FileSink):
+    """FLAT_TABLES as one Parquet file per table in the directory path, with
+    one Arrow record batch per table for every chunk. Needs pyarrow."""
+
+    def __init__(self, path):
+        super(ParquetSink, self).__init__(path)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            sys.stderr.write("\n\nCould not import pyarrow - it is required for the parquet sink\n\n")
+            raise
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        arrow_types = {TEXT: pyarrow.string(), FLOAT: pyarrow.float64()}
+        self.schemas = dict(
+            (table, pyarrow.schema([(fld.name, arrow_types[fld.type]) for fld in fields]))
+            for table, fields in FLAT_TABLES.items()
+        )
+        self.writers = None
+
+    def open_files(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.writers = dict(
+            (table, self.pq.ParquetWriter(
+                self.output(os.path.join(self.path, table + ".parquet")), self.schemas[table]
+            ))
+            for table in FLAT_TABLES
+        )
+
+    def write(self, docs):
+        for table, rows in flat_rows(docs).items():
+            if rows:
+                schema = self.schemas[table]
+                columns = [self.pa.array(col, type=fld.type) for col, fld in zip(zip(*rows), schema)]
+                self.writers[table].write_table(self.pa.Table.from_arrays(columns, schema=schema))
+        return len(docs)
+
+    def close_files(self):
+        if self.writers is not None:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = None
+
+
+# The file sinks by --sink name, each made from an --output path
+FILE_SINKS = {
+    "ndjson": NDJSONSink,
+    "sqlite": SQLiteSink,
+    "parquet": ParquetSink,
+}
+
+
+# Number of chunks the parser may get ahead of the writer threads
+PIPELINE_DEPTH = 4
+
+
+class PipelineStats(object):
+    """Counters for PipelinedSink: how full the queue was when each chunk
+    was queued, and how long each side spent waiting on the other. The
+    writers' stall is added up over all of them, so it is averaged per
+    writer before being compared with the one parser's."""
+
+    def __init__(self, depth, writers=1):
+        self.depth = depth
+        self.writers = writers
+        self.chunks = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.parser_stall = 0.0  # queue full: the writers are behind
+        self.writer_stall = 0.0  # queue empty: the parser is behind
+
+    def queued(self, depth, stall):
+        self.chunks += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.parser_stall += stall
+
+    def report(self):
+        print("Pipeline: %d chunks, queue depth avg %.1f max %d (of %d)" % (
+            self.chunks, self.depth_total / max(self.chunks, 1), self.depth_max, self.depth
+        ))
+        writer_stall = self.writer_stall / self.writers
+        print("  parser stalled %8.3fs waiting for the writers" % self.parser_stall)
+        print("  writers stalled %7.3fs each waiting for the parser (%d writers)" % (writer_stall, self.writers))
+        print("  bottleneck: %s" % ("writing" if self.parser_stall > writer_stall else "parsing"))
+
+
+class PipelinedSink(Sink):
+    """Wraps a sink so write() only queues the chunk: writer threads take
+    chunks off a bounded queue and write them to the inner sink, so building
+    the next chunk overlaps with writing the last. A sink that isn't
+    threadsafe gets a single writer (which also keeps the chunks in order).
+    Errors from the writers are raised by the next write, clear or close."""
+
+    def __init__(self, inner, writers=1, depth=PIPELINE_DEPTH):
+        self.inner = inner
+        if not inner.threadsafe:
+            writers = 1
+        self.chunks = queue.Queue(maxsize=depth)
+        self.stats = PipelineStats(depth, writers)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self.writer, name="nndb-writer-%d" % i)
+            for i in range(writers)
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        print("Writing with %d writer threads" % writers)
+
+    def writer(self):
+        while True:
+            start = time.perf_counter()
+            docs = self.chunks.get()
+            stall = time.perf_counter() - start
+            try:
+                if docs is None:
+                    return
+                if not self.errors:
+                    self.inner.write(docs)
+                    with self.lock:
+                        self.stats.writer_stall += stall
+            except BaseException as e:
+                self.errors.append(e)  # The rest of the queue is dropped
+            finally:
+                self.chunks.task_done()
+
+    def check(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def drain(self):
+        """Wait for every queued chunk to be written"""
+        self.chunks.join()
+        self.check()
+
+    def stop(self):
+        for thread in self.threads:
+            self.chunks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def clear(self):
+        self.drain()
+        self.inner.clear()
+
+    def write(self, docs):
+        self.check()
+        depth = self.chunks.qsize()
+        start = time.perf_counter()
+        self.chunks.put(docs)
+        self.stats.queued(depth, time.perf_counter() - start)
+        return len(docs)
+
+    def close(self):
+        self.drain()
+        self.stop()
+        self.stats.report()
+        self.inner.close()
+
+    def abort(self):
+        self.errors.append(BulkFailure("Import aborted"))
+        self.stop()
+        self.inner.abort()
+
+
+def ndb_ranges(ndb_nums, parts):
+    """Split ndb_nums in to parts ranges holding about the same number of
+    foods. Returns the first NDB number of every range but the first, for
+    use with bisect."""
+    ndb_nums = sorted(ndb_nums)
+    return [ndb_nums[len(ndb_nums) * i // parts] for i in range(1, parts) if ndb_nums]
+
+
+class PartitionedBulk(BulkOps):
+    """Spreads bulk ops over a writer thread per NDB_No range (see
+    ndb_ranges), each with its own ChunkedBulk from sink. All the ops for a
+    food go to the same writer, so they are still executed in order, while
+    the writers run at the same time over their own pooled connections. Ops
+    are handed over in batches of chunk_size through bounded queues. Unlike
+    ChunkedBulk, flush() is final: it waits for every writer to finish."""
+
+    def __init__(self, sink, chunk_size, bounds, depth=PIPELINE_DEPTH):
+        self.bounds = bounds
+        self.chunk_size = chunk_size
+        self.bulks = [sink.chunked_bulk(chunk_size) for _ in range(len(bounds) + 1)]
+        self.batches = [[] for _ in self.bulks]
+        self.queues = [queue.Queue(maxsize=depth) for _ in self.bulks]
+        self.errors = []
+        self.stopped = False
+        self.threads = [
+            threading.Thread(target=self.writer, args=(bulk, ops), name="nndb-bulk-%d" % i)
+            for i, (bulk, ops) in enumerate(zip(self.bulks, self.queues))
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        print("Writing with %d bulk writers split at %s" % (len(self.threads), ", ".join(bounds) or "-"))
+
+    def writer(self, bulk, ops):
+        while True:
+            batch = ops.get()
+            try:
+                if batch is None:
+                    if not self.errors:
+                        bulk.flush()
+                elif not self.errors:
+                    for op in batch:
+                        bulk.add(*op)
+            except BaseException as e:
+                self.errors.append(e)  # The rest of the queue is dropped
+            finally:
+                ops.task_done()
+            if batch is None:
+                return
+
+    def add(self, query, method, args, upsert=False, idempotent=True):
+        if self.errors:
+            self.flush()  # Stops the writers and raises the first error
+        part = bisect.bisect_right(self.bounds, query['_id'])
+        batch = self.batches[part]
+        batch.append((query, method, args, upsert, idempotent))
+        if len(batch) >= self.chunk_size:
+            self.queues[part].put(batch)
+            self.batches[part] = []
+
+    def flush(self):
+        for part, ops in enumerate(self.queues):
+            if self.batches[part]:
+                ops.put(self.batches[part])
+                self.batches[part] = []
+        self.stop()
+        if self.errors:
+            raise self.errors[0]
+
+    def stop(self):
+        """Send every writer the final None and wait for them to finish"""
+        if self.stopped:
+            return
+        self.stopped = True
+        for ops in self.queues:
+            ops.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def abort(self):
+        """Stop the writers, dropping every batch they haven't written"""
+        self.errors.append(BulkFailure("Bulk writes aborted"))
+        self.batches = [[] for _ in self.bulks]
+        self.stop()
+
+    @property
+    def results(self):
+        """The results of every writer added up"""
+        total = {}
+        for bulk in self.bulks:
+            for k, v in bulk.results.items():
+                total[k] = total.get(k, 0 if isinstance(v, int) else []) + v
+        return total
+
+    def report(self):
+        report_bulk(self.results)
+
+
+# Suffixes for the collections used by staged imports
+STAGING_SUFFIX = "_staging"
+BACKUP_SUFFIX = "_backup"
+
+
+def validate_staging(staging, expected):
+    """Make sure the staging collection holds every food we loaded"""
+    count = staging.count()
+    print("Staging collection %s holds %d foods (expected %d)" % (staging.name, count, expected))
+    if count < 1 or count != expected:
+        raise BulkFailure("Staging collection %s failed validation" % staging.name)
+
+
+def copy_indexes(source, dest):
+    """Build every index of source but _id on dest, with the same options"""
+    for name, info in source.index_information().items():
+        if name == "_id_":
+            continue
+        keys = info["key"]
+        if ("_fts", "text") in keys:
+            # The server lists a text index's fields in weights, not key
+            keys = [(k, d) for k, d in keys if k not in ("_fts", "_ftsx")] + [
+                (field, "text") for field in sorted(info["weights"])
+            ]
+        options = dict((k, v) for k, v in info.items() if k not in ("key", "v", "ns"))
+        dest.create_index(keys, name=name, **options)
+
+
+def swap_in(staging, target, backup_name=None):
+    """Replace target with staging in a single (atomic) rename. If
+    backup_name is given the current target (and its indexes, which $out
+    doesn't copy) is copied there first, so readers never see the target
+    missing or partially loaded and a rollback gets an indexed collection."""
+    db = target.database
+    if backup_name and target.name in db.collection_names():
+        print("Copying %s to backup %s" % (target.name, backup_name))
+        list(target.aggregate([{"$out": backup_name}]))
+        copy_indexes(target, db[backup_name])
+
+    print("Renaming %s to %s" % (staging.name, target.name))
+    staging.rename(target.name, dropTarget=True)
+
+
+def rollback(target, backup_name):
+    """Put the backup from the last staged import back in place"""
+    db = target.database
+    if backup_name not in db.collection_names():
+        raise BulkFailure("No backup collection %s to roll back to" % backup_name)
+    print("Renaming %s to %s" % (backup_name, target.name))
+    db[backup_name].rename(target.name, dropTarget=True)
+
+
+def process_directory(
+    sink, dirname,
+    mode="push", chunk_size=INSERT_CHUNK_SIZE, workers=1, parser="mmap",
+    cache_dir=None, rebuild_cache=False, staging=False, backup_name=None,
+    indexes=True, writers=0, progress=None, resume=False, vectors=False,
+    matrix_dir=None, stats=False, phases=1, metrics=None
+):
+    """Process single directory (or release archive), writing to sink: a Sink
+    or a pymongo collection (which gets a MongoSink). Returns the number of
+    foods loaded. The README describes every option in full.
+
+    mode is one of IMPORT_MODES; only DOCUMENT_MODES work with file sinks.
+    workers > 1 parses every file in a process pool; parser is one of PARSERS.
+    cache_dir keeps parsed tables between imports (see CachedSRDirectory).
+    staging loads a separate collection and swaps it in, keeping backup_name.
+    indexes builds the INDEX_PLAN once the documents are loaded.
+    writers > 0 writes the DOCUMENT_MODES through a PipelinedSink.
+    progress is called as progress(phase, foods=0, records=0).
+    resume carries on a push import from its checkpoint (see push_import).
+    vectors stores a NUTRIENT_VECTOR_FIELD on every food (see nutrient_vector).
+    matrix_dir gets the foods x nutrients matrix (see write_nutrient_matrix).
+    stats saves per nutrient statistics to STATS_COLLECTION.
+    phases is how many push mode phases a MongoSink runs at once.
+    metrics (an ImportMetrics) records every phase, file read and write.
+    """
+    if not isinstance(sink, Sink):
+        sink = MongoSink(sink, indexes, writers=max(writers, 1), phases=phases, metrics=metrics)
+    if mode not in IMPORT_MODES:
+        raise ValueError("Unknown import mode %s" % mode)
+    if mode not in DOCUMENT_MODES and not isinstance(sink, MongoSink):
+        raise ValueError("%s mode needs a MongoDB sink" % mode)
+    if staging and not isinstance(sink, MongoSink):
+        raise ValueError("only MongoDB sinks are staged (file sinks are renamed in to place anyway)")
+    if staging and mode == "incremental":
+        raise ValueError("incremental mode writes in place and can't be staged")
+    if resume and mode != "push":
+        raise ValueError("only push mode imports can be resumed")
+    if staging and mode == "normalized":
+        raise ValueError("normalized mode writes several collections and can't be staged")
+    if vectors and (mode == "push" or not isinstance(sink, MongoSink)):
+        raise ValueError("nutrient vectors need a MongoDB sink and a mode that builds whole documents")
+    if stats and not isinstance(sink, MongoSink):
+        raise ValueError("nutrient statistics need a MongoDB sink")
+
+    if metrics is not None:
+        metrics.info.update(mode=mode, release=dirname, workers=workers, writers=writers, phases=phases)
+    phase = (metrics or ImportMetrics()).phase
+
+    def run(release):
+        if cache_dir:
+            release = CachedSRDirectory(release, cache_dir, rebuild_cache)
+        if metrics is not None:
+            release = MeteredSRDirectory(release, metrics)
+        if stats:
+            release = StatsSRDirectory(release)
+        release.prefetch()
+        nutr_defs = vector_nutrients(release) if vectors else None
+        order = [nutr_def["nutrient_id"] for nutr_def in nutr_defs] if vectors else None
+
+        if not staging:
+            count = process_release(sink, release, mode, chunk_size, writers, progress, resume, order, metrics)
+        else:
+            mongo = sink.collection
+            stage = sink.for_collection(mongo.database[mongo.name + STAGING_SUFFIX])
+            print("Loading in to staging collection %s" % stage.collection.name)
+            if not resume:
+                stage.collection.drop()
+            count = process_release(stage, release, mode, chunk_size, writers, progress, resume, order, metrics)
+            if progress:
+                progress("swapping")
+            with phase("swap"):
+                validate_staging(stage.collection, count)
+                swap_in(stage.collection, mongo, backup_name)
+
+        if vectors:
+            with phase("vector_meta"):
+                save_vector_meta(sink.collection, nutr_defs)
+        if stats:
+            with phase("stats"):
+                save_nutrient_stats(sink.collection, release.nutrient_stats(), vector_nutrients(release))
+        if matrix_dir:
+            with phase("matrix"):
+                write_nutrient_matrix(release, matrix_dir)
+        if metrics is not None:
+            metrics.info["foods"] = count
+        return count
+
+    if workers > 1:
+        print("Parsing with %d worker processes" % workers)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return run(open_release(dirname, parser, pool))
+
+    return run(open_release(dirname, parser))
+
+
+def process_release(
+    sink, release, mode, chunk_size, writers=0, progress=None, resume=False, nutrient_order=None, metrics=None
+):
+    """Import the files of release (an SRDirectory) in to sink using mode,
+    pipelined over writers threads if that's more than 0 and reporting to
+    progress if given. resume is only for push mode. With a nutrient_order
+    the food documents get nutrient vectors in that order. Given an
+    ImportMetrics its phases and writes are recorded there."""
+    phase = (metrics or ImportMetrics()).phase
+
+    # Read in various dictionaries we need first
+    if progress:
+        progress("lookups")
+    with phase("lookups"):
+        lookups = load_lookups(release)._replace(nutrient_order=nutrient_order)
+
+    if metrics is not None:
+        sink = MeteredSink(sink, metrics)
+    if progress:
+        sink = ProgressSink(sink, progress)
+    if writers > 0 and mode in DOCUMENT_MODES:
+        sink = PipelinedSink(sink, writers)
+
+    try:
+        # Clearing previous entries
+        # Note that one of main goals is to be restartable and re-runnable.
+        if mode != "incremental" and not resume:
+            with phase("clear"):
+                sink.clear()
+
+        with phase("load:" + mode):
+            if mode == "push":
+                count = push_import(sink, release, lookups, chunk_size, resume, progress)
+            else:
+                count = IMPORT_MODES[mode](sink, release, lookups, chunk_size)
+        with phase("close"):
+            sink.close()
+    except BaseException:
+        sink.abort()
+        raise
+
+    return count
+
+
+# Upper bounds (seconds) of the latency histogram buckets in ImportMetrics
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux says kB
+
+
+class LatencyHistogram(object):
+    """Counts of observed durations per LATENCY_BUCKETS bucket (the last
+    count is for anything slower), plus their number and sum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def as_doc(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[le, n] for le, n in zip(list(self.buckets) + ["+Inf"], self.counts)],
+        }
+
+
+class ImportMetrics(object):
+    """Instrumentation of one import, passed to process_directory: the wall
+    and CPU time of every phase, rows, bytes and time spent parsing each
+    file (see MeteredSRDirectory), latency histograms of sink writes and
+    bulk round trips, counters (like documents written) and the peak RSS,
+    and with trace_memory the tracemalloc peak of every phase (which slows
+    the import down). report() returns it all as a dictionary for
+    write_json, and write_prometheus writes a Prometheus textfile."""
+
+    def __init__(self, trace_memory=False):
+        self.lock = threading.Lock()
+        self.trace_memory = trace_memory
+        self.info = collections.OrderedDict()
+        self.phases = []
+        self.files = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.started = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.wall = self.cpu = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase name. CPU time is the
+        whole process's, so it includes any writer threads."""
+        if self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_phase(self, name, wall, cpu=None):
+        phase = collections.OrderedDict([
+            ('name', name),
+            ('start', time.perf_counter() - self.wall_start - wall),
+            ('wall', wall),
+            ('cpu', cpu),
+            ('peak_rss', peak_rss()),
+        ])
+        if self.trace_memory and tracemalloc.is_tracing():
+            phase['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        with self.lock:
+            self.phases.append(phase)
+
+    def parsed(self, filename, rows, seconds, size=None):
+        """Count a read of filename: a full read of size bytes, or a partial
+        one (abandoned or failed) if size is None"""
+        with self.lock:
+            stats = self.files.setdefault(filename, {
+                'reads': 0, 'full_reads': 0, 'rows': 0, 'bytes': 0, 'parse_seconds': 0.0, 'full_seconds': 0.0
+            })
+            stats['reads'] += 1
+            stats['rows'] += rows
+            stats['parse_seconds'] += seconds
+            if size is not None:
+                stats['full_reads'] += 1
+                stats['bytes'] += size
+                stats['full_seconds'] += seconds
+
+    def observe(self, name, seconds):
+        """Add a duration to the latency histogram name"""
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].observe(seconds)
+
+    def add(self, name, amount=1):
+        """Add amount to the counter name"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish(self, **info):
+        """Stop the clocks (and tracemalloc) and record info (like status)"""
+        self.info.update(info)
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+        if self.trace_memory and tracemalloc.is_tracing():
+            # phase() resets the peak, so the import's is the largest of them
+            self.info['traced_peak'] = max(
+                [tracemalloc.get_traced_memory()[1]] + [phase.get('traced_peak', 0) for phase in self.phases]
+            )
+            tracemalloc.stop()
+
+    def report(self):
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.wall_start
+        cpu = self.cpu if self.cpu is not None else time.process_time() - self.cpu_start
+        with self.lock:
+            files = collections.OrderedDict()
+            for filename, stats in self.files.items():
+                files[filename] = dict(stats)
+                seconds, full_seconds = stats['parse_seconds'], stats['full_seconds']
+                files[filename]['rows_per_s'] = stats['rows'] / seconds if seconds else None
+                files[filename]['bytes_per_s'] = stats['bytes'] / full_seconds if full_seconds else None
+            return collections.OrderedDict([
+                ('started', self.started),
+                ('info', dict(self.info)),
+                ('wall', wall),
+                ('cpu', cpu),
+                ('peak_rss', peak_rss()),
+                ('phases', list(self.phases)),
+                ('files', files),
+                ('histograms', dict((name, hist.as_doc()) for name, hist in self.histograms.items())),
+                ('counters', dict(self.counters)),
+            ])
+
+    def write_json(self, path):
+        with replacing(path) as out:
+            json.dump(self.report(), out, indent=1)
+        print("Wrote metrics to %s" % path)
+
+    def prometheus_lines(self):
+        """The report in the Prometheus text format. Phases of the same name
+        are added up."""
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP nndb_import_%s %s" % (name, help_text))
+            lines.append("# TYPE nndb_import_%s %s" % (name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ",".join('%s="%s"' % (k, str(v).replace('"', "'")) for k, v in labels)
+                lines.append("nndb_import_%s%s %r" % (name, "{%s}" % label_text if label_text else "", float(value)))
+
+        metric("started_timestamp_seconds", "gauge", "When the import started", [((), report['started'])])
+        metric("duration_seconds", "gauge", "Wall time of the whole import", [((), report['wall'])])
+        metric("cpu_seconds", "gauge", "CPU time of the whole import", [((), report['cpu'])])
+        metric("peak_rss_bytes", "gauge", "Peak resident set size", [((), report['peak_rss'])])
+        if "foods" in report['info']:
+            metric("foods", "gauge", "Food documents loaded", [((), report['info']['foods'])])
+        if "status" in report['info']:
+            metric("success", "gauge", "1 if the import finished", [((), report['info']['status'] == "ok")])
+
+        walls, cpus = collections.OrderedDict(), collections.OrderedDict()
+        for phase in report['phases']:
+            walls[phase['name']] = walls.get(phase['name'], 0.0) + phase['wall']
+            if phase['cpu'] is not None:
+                cpus[phase['name']] = cpus.get(phase['name'], 0.0) + phase['cpu']
+        metric("phase_wall_seconds", "gauge", "Wall time of each phase", [((("phase", k),), v) for k, v in walls.items()])
+        metric("phase_cpu_seconds", "gauge", "CPU time of each phase", [((("phase", k),), v) for k, v in cpus.items()])
+
+        for key, help_text in [
+            ("rows", "Rows parsed from each file"),
+            ("reads", "Reads of each file, full or partial"),
+            ("full_reads", "Reads of each file that reached its end"),
+            ("bytes", "Bytes of each file parsed by full reads"),
+            ("parse_seconds", "Time spent parsing each file"),
+        ]:
+            metric("file_" + key, "gauge", help_text, [((("file", f),), v[key]) for f, v in report['files'].items()])
+
+        for name, value in report['counters'].items():
+            metric(name, "gauge", "Total %s over the import" % name, [((), value)])
+
+        for name, hist in report['histograms'].items():
+            lines.append("# HELP nndb_import_%s_seconds Latency of %s calls" % (name, name))
+            lines.append("# TYPE nndb_import_%s_seconds histogram" % name)
+            total = 0
+            for le, count in hist['buckets']:
+                total += count
+                lines.append('nndb_import_%s_seconds_bucket{le="%s"} %d' % (name, le, total))
+            lines.append("nndb_import_%s_seconds_sum %r" % (name, hist['sum']))
+            lines.append("nndb_import_%s_seconds_count %d" % (name, hist['count']))
+        return lines
+
+    def write_prometheus(self, path):
+        """Write a textfile for node_exporter's textfile collector (renamed
+        in to place, as it requires)"""
+        with replacing(path) as out:
+            out.write("\n".join(self.prometheus_lines()) + "\n")
+        print("Wrote Prometheus metrics to %s" % path)
+
+
+class MeteredSRDirectory(WrappedSRDirectory):
+    """Wraps another SRDirectory and reports the rows, bytes and time spent
+    in the parser (or cache) for every read of a file to metrics, including
+    reads given up part way. Only the time taken to produce records is
+    counted, not the time the import spends on them in between."""
+
+    def __init__(self, inner, metrics):
+        super(MeteredSRDirectory, self).__init__(inner)
+        self.metrics = metrics
+
+    def records(self, filename):
+        clock = time.perf_counter
+        recs = iter(self.inner.records(filename))
+        rows, busy, size = 0, 0.0, None
+        try:
+            while True:
+                start = clock()
+                try:
+                    rec = next(recs)
+                except StopIteration:
+                    size = self.size(filename)  # Only a full read covers the file
+                    break
+                finally:
+                    busy += clock() - start
+                rows += 1
+                yield rec
+        finally:
+            # Also reached when the reader gives up (or fails) part way
+            self.metrics.parsed(filename, rows, busy, size)
+
+
+class MeteredSink(Sink):
+    """Wraps a sink to report the latency of every write() (the "write"
+    histogram) and the documents written to metrics"""
+
+    def __init__(self, inner, metrics):
+        self.inner = inner
+        self.metrics = metrics
+        self.threadsafe = inner.threadsafe
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def clear(self):
+        self.inner.clear()
+
+    def write(self, docs):
+        start = time.perf_counter()
+        count = self.inner.write(docs)
+        self.metrics.observe("write", time.perf_counter() - start)
+        self.metrics.add("documents_written", count)
+        return count
+
+    def close(self):
+        self.inner.close()
+
+    def abort(self):
+        self.inner.abort()
+
+
+class ProgressSink(Sink):
+    """Wraps a sink to call progress(phase, foods) as it is cleared, written
+    and closed. Anything else (like MongoSink.collection for the modes that
+    need it) comes from the inner sink."""
+
+    def __init__(self, inner, progress):
+        self.inner = inner
+        self.progress = progress
+        self.threadsafe = inner.threadsafe
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def clear(self):
+        self.inner.clear()
+        self.progress("loading")
+
+    def write(self, docs):
+        count = self.inner.write(docs)
+        self.progress(None, count)
+        return count
+
+    def close(self):
+        self.progress("finishing")
+        self.inner.close()
+
+    def abort(self):
+        self.inner.abort()
+
+
+class ImportProgress(object):
+    """The awaitable progress of process_directory_async: the current phase,
+    the number of food documents written so far and (in push mode) the
+    number of records pushed on to them. The import thread's
+    updates are applied on the event loop; await changed() (or async for)
+    to wait for the next one. Iteration stops when the import is done."""
+
+    def __init__(self):
+        self.phase = "starting"
+        self.foods = 0
+        self.records = 0
+        self.done = False
+        self.loop = None
+        self.event = None
+
+    def attach(self, loop):
+        """Bind to the event loop (the first await or the import does this)"""
+        if self.event is None:
+            self.loop = loop
+            self.event = asyncio.Event()
+
+    def update(self, phase=None, foods=0, records=0):
+        """The process_directory progress callback: safe from any thread"""
+        self.loop.call_soon_threadsafe(self.apply, phase, foods, records)
+
+    def apply(self, phase, foods, records):
+        if phase is not None:
+            self.phase = phase
+        self.foods += foods
+        self.records += records
+        self.event.set()
+
+    def finish(self):
+        self.phase = "done"
+        self.done = True
+        self.event.set()
+
+    async def changed(self):
+        """Wait for the next update and return self"""
+        self.attach(asyncio.get_event_loop())
+        await self.event.wait()
+        self.event.clear()
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done and not self.event.is_set():
+            raise StopAsyncIteration
+        return await self.changed()
+
+
+def validate_directory(dirname, workers=1, parser="mmap", cache_dir=None, rebuild_cache=False):
+    """validate_release for a directory (or archive) read the same way as
+    process_directory would. Nothing is written anywhere but the cache."""
+    def run(release):
+        if cache_dir:
+            release = CachedSRDirectory(release, cache_dir, rebuild_cache)
+        release.prefetch()
+        return validate_release(release)
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            return run(open_release(dirname, parser, pool))
+    return run(open_release(dirname, parser))
+
+
+async def process_directory_async(sink, dirname, progress=None, executor=None, **kwargs):
+    """process_directory for asyncio. PyMongo and the parsers block, so the
+    import runs on executor (the loop's default thread pool if None) and the
+    event loop is never stalled; with writers in kwargs several batches are
+    in flight at once. kwargs are passed on to process_directory. progress
+    (an ImportProgress) is updated as the import goes. Returns the number of
+    foods loaded."""
+    loop = asyncio.get_event_loop()
+    if progress is not None:
+        progress.attach(loop)
+        kwargs["progress"] = progress.update
+    try:
+        return await loop.run_in_executor(
+            executor, functools.partial(process_directory, sink, dirname, **kwargs)
+        )
+    finally:
+        if progress is not None:
+            progress.finish()
+
+
+async def chunks_async(make_iter, chunk_size=INSERT_CHUNK_SIZE, depth=PIPELINE_DEPTH, executor=None):
+    """Async generator of lists of up to chunk_size items from the blocking
+    iterator make_iter() returns, which is run on executor. At most depth
+    chunks are read ahead. Exceptions from the iterator are raised here."""
+    loop = asyncio.get_event_loop()
+    chunks = asyncio.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+    def produce():
+        try:
+            chunk = []
+            for item in make_iter():
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    put(chunk)
+                    chunk = []
+                if stopped.is_set():
+                    return
+            if chunk:
+                put(chunk)
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        # Let a producer blocked on a full queue see that we're done
+        stopped.set()
+        while not chunks.empty():
+            chunks.get_nowait()
+        await producer
+
+
+def records_async(release, filename, chunk_size=INSERT_CHUNK_SIZE):
+    """Async generator of lists of parsed records of filename in release"""
+    return chunks_async(functools.partial(release.records, filename), chunk_size)
+
+
+def foods_async(release, lookups, chunk_size=INSERT_CHUNK_SIZE):
+    """Async generator of lists of complete food documents, merge-joined as
+    in stream mode (so SortOrderError if the release isn't sorted)"""
+    return chunks_async(functools.partial(merge_join_foods, release, lookups), chunk_size)
+
+
+def run_async(coro):
+    """Run coro to completion on a new event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 def main():
     """Entry point"""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "targetdir",
-        help="The directory containing the ASCII data files from "
+        help="The directory containing the ASCII data files, or the release zip (or tar.gz) itself",
+        nargs="?"
     )
     parser.add_argument(
         "--mongourl",
@@ -404,17 +3495,253 @@ def main():
         help="The collection where the data will be loaded (PREV DATA WILL BE DELETED)",
         default="nndb"
     )
+    parser.add_argument(
+        "--mode",
+        help="push: insert FOOD_DES then $push every other row; "
+             "assemble: join all files in memory and insert each food once; "
+             "stream: merge-join the NDB_No sorted files with constant memory; "
+             "incremental: only write foods that changed since the last incremental import; "
+             "normalized: lean foods plus <collection>.nutrient_values and lookup collections "
+             "(default: push for mongo, stream for the file sinks)",
+        choices=sorted(IMPORT_MODES.keys()),
+        default=None
+    )
+    parser.add_argument(
+        "--sink",
+        help="mongo: the --collection at --mongourl; ndjson: gzipped JSON lines; "
+             "sqlite: a database of flat tables; parquet: a directory of flat tables",
+        choices=["mongo"] + sorted(FILE_SINKS.keys()),
+        default="mongo"
+    )
+    parser.add_argument(
+        "--output",
+        help="The file (or directory for parquet) the file sinks write",
+        default=None
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Number of documents per write to the sink (and ops per bulk execute)",
+        type=int,
+        default=INSERT_CHUNK_SIZE
+    )
+    parser.add_argument(
+        "--chunk-bytes",
+        help="Most estimated bytes of ops per bulk execute in push and incremental mode",
+        type=int,
+        default=BULK_CHUNK_BYTES
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes used to parse the data files (1 parses serially)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--writers",
+        help="Number of writer threads fed by the parser (0 writes from the parsing thread). "
+             "push and incremental split the foods between them by NDB_No range",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--phases",
+        help="Number of push mode phases (one per data file) run at once once the foods are inserted",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--write-concern",
+        help="MongoDB write concern w: a number of members or majority (default: the server's)",
+        default=None
+    )
+    parser.add_argument(
+        "--journal",
+        help="Wait for writes to be journaled (write concern j)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--ordered",
+        help="Use ordered inserts and bulk ops (stop at the first error)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--parser",
+        help="mmap: bytes level fast path; text: line by line in text mode",
+        choices=sorted(PARSERS.keys()),
+        default="mmap"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Where parsed tables are cached between runs",
+        default=DEFAULT_CACHE_DIR
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Don't read or write the parsed table cache",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--rebuild-cache",
+        help="Parse every file again and replace its cached table",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--no-indexes",
+        help="Don't drop and rebuild the indexes in INDEX_PLAN around the load",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--vectors",
+        help="Also store the nutrient values of every food as a packed float32 %s "
+             "(described in <collection>.meta)" % NUTRIENT_VECTOR_FIELD,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--matrix",
+        help="Also write the foods x nutrients matrix (%s) to this directory" % ", ".join(NUTRIENT_MATRIX_FILES),
+        default=None
+    )
+    parser.add_argument(
+        "--stats",
+        help="Also save per nutrient statistics (count, mean, variance, min/max food, "
+             "percentiles) to the %s collection" % STATS_COLLECTION,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--validate", "--dry-run",
+        help="Only check that every reference between the files resolves (see FOREIGN_KEYS) "
+             "and print the orphans. Writes nothing and needs no MongoDB",
+        dest="validate",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write the time, CPU and memory of every phase, per file parse throughput and "
+             "write latencies to this JSON file",
+        default=None
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write the same metrics to this Prometheus textfile (for node_exporter's textfile collector)",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-memory",
+        help="Also record the peak of Python allocations in every phase with tracemalloc (slow)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--resume",
+        help="Carry on with the last push mode import in to --collection from its checkpoint",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--staging",
+        help="Load in to a staging collection and rename it over --collection when done",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--backup",
+        help="Where --staging keeps the previous collection (default: <collection>%s)" % BACKUP_SUFFIX,
+        default=None
+    )
+    parser.add_argument(
+        "--no-backup",
+        help="Don't keep the previous collection when using --staging",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--rollback",
+        help="Rename the --backup collection back over --collection and exit",
+        action="store_true"
+    )
     args = parser.parse_args()
+    if not args.targetdir and not args.rollback:
+        parser.error("targetdir is required")
+    if args.sink != "mongo" and not args.output and not args.validate:
+        parser.error("--output is required for the %s sink" % args.sink)
+    if args.sink != "mongo" and not args.validate:
+        for flag, given in [("--staging", args.staging), ("--resume", args.resume),
+                            ("--vectors", args.vectors), ("--stats", args.stats)]:
+            if given:
+                parser.error("%s needs the mongo sink, not %s" % (flag, args.sink))
+        if args.mode and args.mode not in DOCUMENT_MODES:
+            parser.error("--mode %s needs the mongo sink, not %s" % (args.mode, args.sink))
 
     print(args.targetdir)
 
+    if args.validate:
+        problems = validate_directory(
+            args.targetdir, workers=args.workers, parser=args.parser,
+            cache_dir=None if args.no_cache else args.cache_dir, rebuild_cache=args.rebuild_cache
+        )
+        sys.exit(1 if problems else 0)
+
+    metrics = None
+    if args.metrics_json or args.metrics_prom or args.trace_memory:
+        metrics = ImportMetrics(trace_memory=args.trace_memory)
+
+    def run_import(coro):
+        """Run the import, writing the metrics whether or not it succeeds"""
+        status = "failed"
+        try:
+            run_async(coro)
+            status = "ok"
+        finally:
+            if metrics is not None:
+                metrics.finish(status=status)
+                if args.metrics_json:
+                    metrics.write_json(args.metrics_json)
+                if args.metrics_prom:
+                    metrics.write_prometheus(args.metrics_prom)
+
+    if args.sink != "mongo":
+        print("Writing %s to %s" % (args.sink, args.output))
+        run_import(process_directory_async(
+            FILE_SINKS[args.sink](args.output), args.targetdir,
+            mode=args.mode or "stream", chunk_size=args.chunk_size, workers=args.workers,
+            parser=args.parser,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            rebuild_cache=args.rebuild_cache, writers=args.writers,
+            staging=args.staging, resume=args.resume, vectors=args.vectors,
+            matrix_dir=args.matrix, stats=args.stats, metrics=metrics
+        ))
+        return
+
     print("Connecting to %s" % args.mongourl)
     client = pymongo.MongoClient(args.mongourl)
     db = client.get_default_database()
     print("Using collection %s" % args.collection)
     coll = db[args.collection]
+
+    write_concern = None
+    if args.write_concern is not None or args.journal:
+        w = args.write_concern
+        write_concern = pymongo.write_concern.WriteConcern(
+            w=int(w) if w and w.isdigit() else w,
+            j=True if args.journal else None
+        )
+
+    backup_name = args.backup or (args.collection + BACKUP_SUFFIX)
+    if args.rollback:
+        rollback(coll, backup_name)
+        return
+
     print("Processing files using directory %s" % args.targetdir)
-    process_directory(coll, args.targetdir)
+    run_import(process_directory_async(
+        MongoSink(
+            coll, not args.no_indexes, args.chunk_bytes,
+            writers=max(args.writers, 1), write_concern=write_concern, ordered=args.ordered,
+            phases=args.phases, metrics=metrics
+        ), args.targetdir,
+        mode=args.mode or "push", chunk_size=args.chunk_size, workers=args.workers,
+        parser=args.parser,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        rebuild_cache=args.rebuild_cache, writers=args.writers,
+        staging=args.staging, resume=args.resume, vectors=args.vectors,
+        matrix_dir=args.matrix, stats=args.stats, phases=args.phases, metrics=metrics,
+        backup_name=None if args.no_backup else backup_name
+    ))
 
 
 if __name__ == "__main__":